@@ -1,5 +1,6 @@
 from .discover_net import DiscoverNet
 from .discover_serial import DiscoverSerial
+from .fleet import Fleet
 from .repl import ReplException
 from .config_store import Config
 from .version import __version__
@@ -0,0 +1,26 @@
+import json
+import os
+import tempfile
+
+
+"""
+Files in `cache_dir` (uids, digests, host index, manifests, device settings).
+
+Several processes (or instances in one process) may save the same file at
+the same time, so each writes a uniquely named temporary file next to it and
+renames it over the old version. Readers see either version, never a partial
+file.
+"""
+
+
+def atomic_json_save(path, obj):
+    """Write obj as JSON to path, replacing the file in one step. Raises OSError."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_file, path)
+    except:
+        os.remove(tmp_file)
+        raise
@@ -56,6 +56,14 @@ class Config:
             return h.get('projects')
         return ['base']
 
+    @staticmethod
+    def host_setting(uid, name, default=None):
+        """Setting for device uid from hosts.py, else from config.py, else default."""
+        h = Config.hosts().get(uid)
+        if isinstance(h, dict) and name in h:
+            return h[name]
+        return Config.get(name, default)
+
     @staticmethod
     def get_config(file='config.py'):
         """Load configuration from cache or disk."""
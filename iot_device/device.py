@@ -7,11 +7,17 @@ import logging
 
 logger = logging.getLogger(__file__)
 
+# bytes requested from the device per read_raw
+READ_SIZE = 4096
+
 
 class Device(ABC):
 
     def __init__(self, uid=None, last_seen=0):
         self.__lock = threading.Lock()
+        self.__negotiated = {}
+        # data received from the device but not yet returned by read*
+        self.__buffer = bytearray()
         if uid:
             self.__uid = uid
         else:
@@ -24,36 +30,93 @@ class Device(ABC):
     def uid(self):
         return self.__uid
 
+    @property
+    def negotiated(self) -> dict:
+        """Protocol settings agreed with the device (e.g. transfer window).
+        Kept across `with device as repl` blocks.
+        """
+        return self.__negotiated
+
     @abstractmethod
-    def read(self, size=1) -> bytes:
-        """Read size bytes"""
+    def read_raw(self, size=1) -> bytes:
+        """Read up to size bytes, waiting (at most the device timeout) for at least one.
+        Returns what is available, not necessarily size bytes. The result may be a
+        view of a buffer reused by the next read_raw.
+        """
         pass
 
     @abstractmethod
-    def read_all(self) -> bytes:
+    def read_all_raw(self) -> bytes:
         """Read all available data"""
         pass
 
+    def read(self, size=1) -> bytes:
+        """Read size bytes, fewer if the device times out."""
+        buffer = self.__buffer
+        while len(buffer) < size:
+            b = self.read_raw(max(size - len(buffer), READ_SIZE))
+            if not b:
+                break
+            buffer.extend(b)
+        res = bytes(buffer[:size])
+        del buffer[:size]
+        return res
+
+    def read_all(self) -> bytes:
+        """Read all available data"""
+        if self.__buffer:
+            res = bytes(self.__buffer)
+            self.__buffer.clear()
+            return res
+        return self.read_all_raw()
+
     @abstractmethod
     def write(self, data: bytes):
         """Writes data"""
         pass
 
+    def write_direct(self, data: bytes):
+        """Writes data without pacing.
+        For protocols with flow control by the device (raw-paste mode).
+        """
+        return self.write(data)
+
+    def drained(self, size, seconds):
+        """Called by protocols with flow control by the device (acks):
+        the device consumed size bytes in seconds. Used to pace write.
+        """
+        pass
+
     def close(self):
         pass
 
+    def fileno(self):
+        """File descriptor that is readable when data from the device is available.
+        None if not supported (DeviceServer then polls read in a thread).
+        """
+        return None
+
     def read_until(self, pattern: bytes, timeout=5):
         """Read until pattern
+        Data following the pattern is kept for the next read.
         Raises TimeoutError
         """
-        result = bytearray()
+        buffer = self.__buffer
         start = time.monotonic()
-        while not result.endswith(pattern):
+        searched = 0
+        while True:
+            i = buffer.find(pattern, searched)
+            if i >= 0:
+                res = bytes(buffer[:i+len(pattern)])
+                del buffer[:i+len(pattern)]
+                return res
+            # pattern may straddle the next chunk
+            searched = max(0, len(buffer) - len(pattern) + 1)
             if (time.monotonic() - start) > timeout:
+                result = bytes(buffer)
+                buffer.clear()
                 raise TimeoutError(f"Timeout reading from IoT device, got '{result}', expect '{pattern}'")
-            b = self.read(size=1)
-            result.extend(b)
-        return result
+            buffer.extend(self.read_raw(READ_SIZE))
 
     @property
     def age(self) -> float:
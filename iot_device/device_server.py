@@ -6,6 +6,7 @@ import socket
 import selectors
 import ssl
 import threading
+import queue
 import json
 import time
 import tempfile
@@ -14,6 +15,71 @@ import logging
 logger = logging.getLogger(__file__)
 
 
+"""
+Relay connections from NetDevice clients to devices (e.g. on serial ports).
+
+The relay is event driven: client sockets and the file descriptors of the
+devices (Device.fileno) are in one selector and data is forwarded only when
+it is available. Devices without a file descriptor are read by a thread per
+connection that queues the data and wakes up the selector. Writing to a
+device may block (SerialDevice paces its output), data from the client is
+queued for a writer thread per connection. The relay stops reading from a
+client while WRITE_BACKLOG chunks of its data are waiting.
+
+New connections go through the TLS handshake and authentication (a JSON
+message with uid and password, terminated by a newline) without blocking
+the relay. Connections that do not complete both within `auth_timeout`
+seconds are closed. Devices are then opened in a thread, since this may
+involve a conversation with the device. Clients are answered 'ok' once it
+is open, and are rejected if opening fails.
+
+Clients resume TLS sessions (session tickets issued by the server's
+context) and may keep idle connections for reuse (see NetDevice). A pooled
+connection keeps its device locked, set `relay_idle_timeout` (seconds) to
+close connections without traffic and free their device.
+
+Devices are advertised in batches, many uids per UDP datagram (at most
+`advertise_packet_size` bytes), to the broadcast address or to the multicast
+group `advertise_group`. Devices that appear or disappear are advertised
+right away, all devices every `advertise_refresh` seconds (default 2, less
+than the 4 seconds clients listen in a scan). Clients that do not understand
+batches get one message per device every `device_scan_interval` seconds, as
+before; set `advertise_legacy = False` once all clients are upgraded.
+"""
+
+# maximum size of authentication message
+AUTH_MESSAGE_SIZE = 1024
+
+# batched advertisements, one message per device for protocol 'repl'
+ADVERTISE_PROTOCOL = 'repl-batch'
+
+# chunks (up to recv_buffer_size bytes each) queued for the device writer
+WRITE_BACKLOG = 4
+
+
+class Connection:
+    """Client connected to a device."""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.device = None
+        # authentication: deadline and message received so far
+        self.deadline = time.monotonic() + Config.get('auth_timeout', 5)
+        self.buf = bytearray()
+        # device file descriptor registered with selector, None: read by thread
+        self.fd = -1
+        self.empty_reads = 0
+        self.closed = False
+        self.last_active = time.monotonic()
+        # data for the device, written by a thread (None ends it)
+        self.writes = queue.Queue()
+        # not reading from client, too much data queued
+        self.paused = False
+        # thread reading device without file descriptor
+        self.reader = None
+
+
 class DeviceServer():
 
     def __init__(self, discovery, max_age=5):
@@ -33,6 +99,7 @@ class DeviceServer():
 
     def __device_server(self):
         # serve multiple connections to different devices in parallel
+        # selector data is the function handling the event
         self.__sel = selectors.DefaultSelector()
         lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -41,21 +108,39 @@ class DeviceServer():
         lsock.listen()
         logger.info(f"Listening for connections on {self.__ip}:{port}")
         lsock.setblocking(False)
-        self.__sel.register(lsock, selectors.EVENT_READ, data=None)
+        self.__sel.register(lsock, selectors.EVENT_READ, data=lambda: self.__accept_wrapper(lsock))
+        # data from reader threads (devices without fileno) and functions to call
+        self.__queue = queue.Queue()
+        self.__wakeup_r, self.__wakeup_w = socket.socketpair()
+        self.__wakeup_r.setblocking(False)
+        self.__sel.register(self.__wakeup_r, selectors.EVENT_READ, data=self.__forward_queued)
+        # connections not yet authenticated, and relaying
+        self.__pending = set()
+        self.__relays = set()
+        # uids of devices being opened (__open)
+        self.__opening = set()
+        # receive buffer for all client connections
+        self.__buffer = memoryview(bytearray(Config.get('recv_buffer_size', 65536)))
+        idle_timeout = Config.get('relay_idle_timeout', 0)
         while True:
-            events = self.__sel.select(timeout=None)
+            timed = self.__pending or (idle_timeout and self.__relays)
+            events = self.__sel.select(timeout=1 if timed else None)
             for key, mask in events:
-                if key.data is None:
-                    # connect request (key.fileobj is socket)
-                    self.__accept_wrapper(key.fileobj)
-                else:
-                    # client connection
-                    self.__service_connection(key, mask)
+                key.data()
+            now = time.monotonic()
+            for c in list(self.__pending):
+                if now > c.deadline:
+                    logger.info(f"Authentication of {c.addr} timed out")
+                    self.__reject(c)
+            if idle_timeout:
+                for c in list(self.__relays):
+                    if now - c.last_active > idle_timeout:
+                        logger.info(f"Closing idle connection to {c.device.uid}")
+                        self.__close(c)
 
     def __accept_wrapper(self, sock):
-        # accept connection
+        # accept connection, TLS handshake and authentication follow as data arrives
         conn, addr = sock.accept()
-        conn = self.__ssl_context.wrap_socket(conn, server_side=True)
         # More quickly detect bad clients who quit without closing the
         # connection: After 1 second of idle, start sending TCP keep-alive
         # packets every 1 second. If 3 consecutive keep-alive packets
@@ -68,88 +153,355 @@ class DeviceServer():
         except AttributeError:
             pass  # not available on windows
         conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        # get uid and password (blocking recv)
-        # TODO: check for incomplete message!
-        uid_pwd = json.loads(conn.recv(1024).decode())
+        conn.setblocking(False)
+        conn = self.__ssl_context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+        c = Connection(conn, addr)
+        self.__pending.add(c)
+        self.__sel.register(conn, selectors.EVENT_READ, data=lambda: self.__handshake(c))
+
+    def __handshake(self, c):
+        # next step of TLS handshake
+        try:
+            c.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.__sel.modify(c.sock, selectors.EVENT_READ, data=lambda: self.__handshake(c))
+            return
+        except ssl.SSLWantWriteError:
+            self.__sel.modify(c.sock, selectors.EVENT_WRITE, data=lambda: self.__handshake(c))
+            return
+        except OSError as e:
+            logger.info(f"TLS handshake with {c.addr} failed ({e})")
+            self.__reject(c)
+            return
+        self.__sel.modify(c.sock, selectors.EVENT_READ, data=lambda: self.__authenticate(c))
+        # data may have arrived with the handshake
+        self.__authenticate(c)
+
+    def __authenticate(self, c):
+        # collect uid and password, then connect client to device
+        try:
+            eof = not self.__recv(c.sock, c.buf)
+        except OSError as e:
+            logger.info(f"Authentication of {c.addr} failed ({e})")
+            self.__reject(c)
+            return
+        try:
+            uid_pwd, rest = _auth_message(c.buf)
+        except ValueError:
+            logger.info(f"Malformed authentication message from {c.addr}")
+            self.__reject(c)
+            return
+        if uid_pwd is None:
+            if eof or len(c.buf) > AUTH_MESSAGE_SIZE:
+                self.__reject(c)
+            return
         uid = uid_pwd.get('uid', '?')
         device = self.__discovery.get_device(uid)
-        logger.debug(f"Request from {addr} to {uid}")
+        logger.debug(f"Request from {c.addr} to {uid}")
         # check password & device status
         ans = None
         if uid_pwd.get('password') != Config.get('password'):
             ans = b'wrong password'
         elif not device:
             ans = b'no such device'
-        elif device.locked:
+        elif device.locked or uid in self.__opening:
             ans = b'device busy'
         if ans:
-            conn.write(ans)
-            conn.close()
-        else:
-            conn.write(b'ok')
-            conn.setblocking(False)
+            self.__reject(c, ans)
+            return
+        # opening the device may take a while (e.g. SerialDevice checks a cached uid),
+        # the client is not served until it is done
+        self.__pending.discard(c)
+        self.__sel.unregister(c.sock)
+        self.__opening.add(uid)
+        th = threading.Thread(target=self.__open, args=(c, device, rest), name=f"Open {uid}")
+        th.setDaemon(True)
+        th.start()
+
+    def __open(self, c, device, rest):
+        # enter device (runs in a thread), the relay continues with __opened
+        try:
             device.__enter__()
-            events = selectors.EVENT_READ | selectors.EVENT_WRITE
-            self.__sel.register(conn, events, data=device)
+            error = None
+        except Exception as e:
+            error = e
+        self.__queue.put((c, lambda: self.__opened(c, device, rest, error)))
+        self.__wakeup_w.send(b'\x00')
 
-    def __service_connection(self, key, mask):
+    def __opened(self, c, device, rest, error):
+        # connect client to device opened by __open
+        self.__opening.discard(device.uid)
+        if error:
+            logger.info(f"Cannot open {device.uid} for {c.addr} ({error})")
+            self.__reject(c, b'device not available')
+            return
         try:
-            sock = key.fileobj
-            device = key.data
-            if mask & selectors.EVENT_READ:
-                recv_data = sock.recv(256)
-                if recv_data:
-                    device.write(recv_data)
-                else:
-                    logger.info(f"Closing connection to {device.uid}")
-                    self.__sel.unregister(sock)
-                    sock.close()
-                    device.__exit__(None, None, None)
-            if mask & selectors.EVENT_WRITE:
-                # forward data from device, if any
-                msg = device.read_all()
-                if len(msg) > 0: 
-                    sock.sendall(msg)            
-        except (SerialException, ConnectionResetError) as e:
-            logger.info(f"Communication with {device.uid} failed, closing connection ({e})")
-            self.__sel.unregister(sock)
-            sock.close()
+            c.sock.sendall(b'ok')
+        except OSError:
             device.__exit__(None, None, None)
+            self.__reject(c)
+            return
+        self.__relays.add(c)
+        c.device = device
+        self.__sel.register(c.sock, selectors.EVENT_READ, data=lambda: self.__client_readable(c))
+        th = threading.Thread(target=self.__writer, args=(c, ), name=f"Write {device.uid}")
+        th.setDaemon(True)
+        th.start()
+        self.__watch_device(c)
+        if c.fd is not None:
+            # data buffered by the device before the connection
+            self.__device_readable(c)
+        if rest:
+            self.__forward_client(c, rest)
+
+    def __reject(self, c, ans=None):
+        # close connection that failed authentication
+        self.__pending.discard(c)
+        if ans:
+            try:
+                c.sock.sendall(ans)
+            except OSError:
+                pass
+        try:
+            self.__sel.unregister(c.sock)
+        except (KeyError, ValueError):
+            # not registered while the device is opened
+            pass
+        c.sock.close()
+        c.closed = True
+
+    def __recv(self, sock, buf):
+        # append available data to buf, False if the connection was closed
+        try:
+            while True:
+                n = sock.recv_into(self.__buffer)
+                if not n:
+                    return False
+                buf.extend(self.__buffer[:n])
+                # data decrypted by ssl is not signaled by the selector
+                if not sock.pending():
+                    return True
+        except ssl.SSLWantReadError:
+            return True
+
+    def __watch_device(self, c):
+        # register device file descriptor (changes if the device reconnects)
+        fd = c.device.fileno()
+        if fd == c.fd:
+            return
+        if c.fd is not None and c.fd >= 0:
+            self.__sel.unregister(c.fd)
+        c.fd = fd
+        if fd is not None:
+            self.__sel.register(fd, selectors.EVENT_READ, data=lambda: self.__device_readable(c))
+        else:
+            c.reader = threading.Thread(target=self.__reader, args=(c, ), name=f"Read {c.device.uid}")
+            c.reader.setDaemon(True)
+            c.reader.start()
+
+    def __client_readable(self, c):
+        try:
+            while not (c.closed or c.paused):
+                n = c.sock.recv_into(self.__buffer)
+                if not n:
+                    logger.info(f"Closing connection to {c.device.uid}")
+                    self.__close(c)
+                    break
+                c.last_active = time.monotonic()
+                self.__forward_client(c, self.__buffer[:n])
+                # data decrypted by ssl is not signaled by the selector
+                if not c.sock.pending():
+                    break
+        except ssl.SSLWantReadError:
+            pass
+        except OSError as e:
+            logger.info(f"Communication with {c.device.uid} failed, closing connection ({e})")
+            self.__close(c)
+
+    def __forward_client(self, c, data):
+        # copy, the receive buffer is reused
+        c.writes.put(bytes(data))
+        if c.writes.qsize() >= WRITE_BACKLOG:
+            # device is slow, let TCP flow control hold back the client
+            c.paused = True
+            self.__sel.unregister(c.sock)
+            if c.writes.qsize() < WRITE_BACKLOG:
+                # writer caught up in the meantime, the caller continues reading
+                c.paused = False
+                self.__sel.register(c.sock, selectors.EVENT_READ, data=lambda: self.__client_readable(c))
+
+    def __resume(self, c):
+        # read from client again (paused by __forward_client)
+        if c.paused and not c.closed:
+            c.paused = False
+            self.__sel.register(c.sock, selectors.EVENT_READ, data=lambda: self.__client_readable(c))
+            # data decrypted by ssl is not signaled by the selector
+            if c.sock.pending():
+                self.__client_readable(c)
+
+    def __writer(self, c):
+        # write data from client to device (runs in a thread)
+        # releases the device when the connection is closed
+        failed = False
+        while True:
+            data = c.writes.get()
+            if data is None:
+                break
+            if failed or c.closed:
+                continue
+            try:
+                c.device.write(data)
+            except Exception as e:
+                failed = True
+                self.__queue.put((c, e))
+                self.__wakeup_w.send(b'\x00')
+                continue
+            if c.paused and c.writes.qsize() < WRITE_BACKLOG:
+                self.__queue.put((c, lambda: self.__resume(c)))
+                self.__wakeup_w.send(b'\x00')
+        if c.reader:
+            # may be reading the device
+            c.reader.join()
+        c.device.__exit__(None, None, None)
+
+    def __device_readable(self, c):
+        # forward data from device
+        try:
+            msg = c.device.read_all()
+            if msg:
+                c.empty_reads = 0
+                c.last_active = time.monotonic()
+                c.sock.sendall(msg)
+            else:
+                # e.g. serial port disconnected
+                c.empty_reads += 1
+                if c.empty_reads > 10:
+                    raise SerialException("device readable but no data")
+            self.__watch_device(c)
+        except (SerialException, OSError) as e:
+            logger.info(f"Communication with {c.device.uid} failed, closing connection ({e})")
+            self.__close(c)
+
+    def __reader(self, c):
+        # wait for data from a device without fileno and queue it for forwarding
+        failed = False
+        while not c.closed:
+            if failed:
+                time.sleep(0.1)
+                continue
+            try:
+                msg = c.device.read(1)
+                if msg:
+                    msg = bytes(msg) + bytes(c.device.read_all())
+            except Exception as e:
+                msg = e
+                failed = True
+            if msg:
+                self.__queue.put((c, msg))
+                self.__wakeup_w.send(b'\x00')
+
+    def __forward_queued(self):
+        try:
+            self.__wakeup_r.recv(4096)
+        except BlockingIOError:
+            pass
+        while not self.__queue.empty():
+            c, msg = self.__queue.get()
+            if callable(msg):
+                # e.g. __opened, continues work done in a thread
+                msg()
+                continue
+            if c.closed: continue
+            try:
+                if isinstance(msg, Exception):
+                    raise msg
+                c.sock.sendall(msg)
+            except (SerialException, OSError) as e:
+                logger.info(f"Communication with {c.device.uid} failed, closing connection ({e})")
+                self.__close(c)
+
+    def __close(self, c):
+        if c.closed:
+            return
+        c.closed = True
+        self.__relays.discard(c)
+        if not c.paused:
+            self.__sel.unregister(c.sock)
+        if c.fd is not None and c.fd >= 0:
+            try:
+                self.__sel.unregister(c.fd)
+            except (KeyError, ValueError):
+                pass
+        c.sock.close()
+        # writer releases the device
+        c.writes.put(None)
 
     def __advertise(self):
+        # changes are sent when they are noticed, all devices every `advertise_refresh` seconds
+        # legacy (per device) messages on every pass
+        wakeup = threading.Event()
+        self.__discovery.add_listener(added=lambda dev: wakeup.set(), removed=lambda dev: wakeup.set())
         s = None
+        advertised = set()
+        last_refresh = 0
         while True:
             try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP socket
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-                advertise_port = Config.get('advertise_port')
+                if not s:
+                    s = self.__advertise_socket()
                 self.__discovery.scan()
                 with self.__discovery as devices:
-                    for dev in devices:
-                        if dev.age > self.__max_age: 
-                            # logger.debug(f"Not advertising {dev}, age {dev.age} > {self.max_age}")
-                            continue
-                        msg = {
-                            'uid': dev.uid,
-                            'ip_addr': self.__ip,
-                            'ip_port': Config.get('connection_server_port'),
-                            'protocol': 'repl',
-                            'last_seen': dev.last_seen,
-                        }
-                        data = json.dumps(msg)
-                        s.sendto(data.encode(), ('255.255.255.255', advertise_port))
-                        # logger.debug(f"Advertise {dev}")
+                    current = { dev.uid: dev for dev in devices if dev.age <= self.__max_age and dev.uid }
+                uids = current.keys()
+                if time.monotonic() - last_refresh >= Config.get('advertise_refresh', 2):
+                    self.__send_advertisements(s, uids, advertised - uids)
+                    last_refresh = time.monotonic()
+                elif uids != advertised:
+                    self.__send_advertisements(s, uids - advertised, advertised - uids)
+                if Config.get('advertise_legacy', True):
+                    self.__send_legacy(s, current.values())
+                advertised = set(uids)
             except Exception as e:
                 # restart, e.g. in case of [Errno 51] Network is unreachable
-                logger.exception(f"Network unreachabl (advertise), attempting to reconnect: {e}")
+                logger.exception(f"Network unreachable (advertise), attempting to reconnect: {e}")
                 if s:
                     try:
                         s.close()
                     except:
                         pass
+                    s = None
                 time.sleep(5)
-            time.sleep(Config.get('device_scan_interval', 1))
+            wakeup.wait(Config.get('device_scan_interval', 1))
+            wakeup.clear()
+
+    def __advertise_socket(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP socket
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if Config.get('advertise_group'):
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, Config.get('advertise_ttl', 1))
+        else:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        return s
+
+    def __send_advertisements(self, s, uids, gone):
+        if not (uids or gone): return
+        dest = (Config.get('advertise_group') or '255.255.255.255', Config.get('advertise_port'))
+        msgs = _advertisements(self.__ip, Config.get('connection_server_port'), sorted(uids), sorted(gone),
+                              Config.get('advertise_packet_size', 1400))
+        for msg in msgs:
+            s.sendto(msg, dest)
+
+    def __send_legacy(self, s, devices):
+        # one message per device, understood by old clients
+        dest = (Config.get('advertise_group') or '255.255.255.255', Config.get('advertise_port'))
+        for dev in devices:
+            msg = {
+                'uid': dev.uid,
+                'ip_addr': self.__ip,
+                'ip_port': Config.get('connection_server_port'),
+                'protocol': 'repl',
+                'last_seen': dev.last_seen,
+            }
+            s.sendto(json.dumps(msg).encode(), dest)
 
     def __my_ip(self):
         # determine host's ip address
@@ -172,6 +524,44 @@ class DeviceServer():
 
 
 
+def _auth_message(buf):
+    """Authentication message (dict) and data following it, (None, None) if incomplete.
+    Raises ValueError if the message is malformed.
+    """
+    if b'\n' in buf:
+        msg, rest = bytes(buf).split(b'\n', 1)
+    else:
+        # clients that do not terminate the message
+        msg, rest = bytes(buf), b''
+        try:
+            json.loads(msg.decode())
+        except ValueError:
+            return None, None
+    msg = json.loads(msg.decode())
+    if not isinstance(msg, dict):
+        raise ValueError("authentication message must be a dict")
+    return msg, rest
+
+
+def _advertisements(ip_addr, ip_port, uids, gone=(), size=1400):
+    """Batched advertisements (encoded JSON) for uids and devices that are gone,
+    each at most size bytes (unless a single uid does not fit).
+    """
+    base = { 'protocol': ADVERTISE_PROTOCOL, 'ip_addr': ip_addr, 'ip_port': ip_port, 'uids': [], 'gone': [] }
+    base_size = len(json.dumps(base))
+    msgs = []
+    msg = None
+    for key, uid in [ ('uids', u) for u in uids ] + [ ('gone', u) for u in gone ]:
+        # uid and separator
+        n = len(json.dumps(uid)) + 2
+        if msg is None or msg_size + n > size:
+            msg = dict(base, uids=[], gone=[])
+            msg_size = base_size
+            msgs.append(msg)
+        msg[key].append(uid)
+        msg_size += n
+    return [ json.dumps(m, separators=(',', ':')).encode() for m in msgs ]
+
 ##########################################################################
 # Main
 
@@ -188,6 +578,7 @@ def main():
 
     from .discover_serial import DiscoverSerial
     discover = DiscoverSerial()
+    discover.start()
     server = DeviceServer(discover, 5*Config.get('device_scan_interval', 1))
     print("started server", server)
 
@@ -0,0 +1,68 @@
+from .config_store import Config
+from .cache_file import atomic_json_save
+
+import json
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+"""
+Settings learned for each device (by uid), e.g. the rate at which it drains
+serial input. Stored in `device_settings.json`, so they need not be learned
+again in the next session.
+Settings in hosts.py or config.py take precedence (see Config.host_setting).
+
+    settings = device_settings()
+    rate = settings.get(uid, 'drain_rate')
+    settings.put(uid, 'drain_rate', 20000)
+    settings.save()
+"""
+
+
+class DeviceSettings:
+
+    def __init__(self, name='device_settings.json'):
+        self.__file = os.path.join(os.path.expanduser(Config.get('cache_dir')), name)
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        try:
+            with open(self.__file) as f:
+                self.__cache = json.load(f)
+        except (OSError, ValueError):
+            self.__cache = {}
+
+    def get(self, uid, key, default=None):
+        return self.__cache.get(uid, {}).get(key, default)
+
+    def put(self, uid, key, value):
+        if not uid: return
+        with self.__lock:
+            settings = self.__cache.setdefault(uid, {})
+            if settings.get(key) != value:
+                settings[key] = value
+                self.__dirty = True
+
+    def save(self):
+        """Write settings to disk (if changed)."""
+        with self.__lock:
+            if not self.__dirty: return
+            try:
+                atomic_json_save(self.__file, self.__cache)
+                self.__dirty = False
+            except OSError as e:
+                logger.warning(f"Cannot save {self.__file}: {e}")
+
+
+_settings = None
+_settings_lock = threading.Lock()
+
+def device_settings():
+    """DeviceSettings shared by all devices."""
+    global _settings
+    with _settings_lock:
+        if _settings is None:
+            _settings = DeviceSettings()
+        return _settings
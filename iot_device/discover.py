@@ -1,3 +1,5 @@
+from .config_store import Config
+
 from abc import ABC, abstractmethod
 import threading
 import logging
@@ -5,46 +7,138 @@ import logging
 logger = logging.getLogger(__file__)
 
 """
-Thread-safe dict uid-->device.
+Thread-safe registry of devices, indexed by key (device.__hash__, e.g. port),
+uid and hostname.
 Iterate over all known devices (regardless of age):
 
     ds = DiscoverSerial()
     with ds as devices:
         for d in devices:
             print(d)
+
+Changes (add_device, remove_device, evict) replace the index, lookups and
+iteration use the current index without locking, so they do not wait for
+scan(). Devices not seen for `device_ttl` seconds are evicted after a scan.
+Removed and evicted devices are closed (e.g. their serial port), unless in use.
+
+Get notified of changes, or wait for a device:
+
+    ds.add_listener(added=lambda d: print("+", d), removed=lambda d: print("-", d))
+    device = ds.wait_for(uid, timeout=10)
 """
 
 class Discover(ABC):
 
     def __init__(self):
-        # __devices: hash --> device
-        self.__devices = {}
+        # writers are serialized by __devices_lock, readers use __index
+        self.__index = Index({})
         self.__devices_lock = threading.Lock()
+        # notified when devices are added
+        self.__added = threading.Condition()
+        self.__listeners = []
 
     def add_device(self, device):
-        assert not device.__hash__() in self.__devices
-        """Add device to dict; set age to zero if it is already in the dict."""           
+        """Add device to dict; set age to zero if it is already in the dict."""
+        assert not device.__hash__() in self.__index.devices
         logger.debug(f"add_device {device}")
+        device.seen()
         with self.__devices_lock:
-            self.__devices[device.__hash__()] = device             
+            devices = dict(self.__index.devices)
+            devices[device.__hash__()] = device
+            self.__index = Index(devices)
+        with self.__added:
+            self.__added.notify_all()
+        self.__notify(0, device)
 
-    def get_device(self, uid):
+    def remove_device(self, device):
         with self.__devices_lock:
-            for d in self.__devices.values():
-                if d.uid == uid: return d
-        return None
+            devices = dict(self.__index.devices)
+            removed = devices.pop(device.__hash__(), None)
+            if removed:
+                self.__index = Index(devices)
+        if removed:
+            self.__notify(1, removed)
+            self.__close(removed)
+
+    def add_listener(self, added=None, removed=None):
+        """Call added(device) and removed(device) when the registry changes."""
+        self.__listeners.append((added, removed))
+
+    def wait_for(self, uid, timeout=None):
+        """Device with uid, waiting up to timeout seconds for it to be added.
+        Returns None if it is not found in time.
+        """
+        with self.__added:
+            self.__added.wait_for(lambda: self.get_device(uid), timeout)
+        return self.get_device(uid)
+
+    def evict(self, ttl=None):
+        """Remove devices not seen for ttl seconds (default `device_ttl` in config.py, 60).
+        Devices in use are kept.
+        """
+        if ttl is None:
+            ttl = Config.get('device_ttl', 60)
+        with self.__devices_lock:
+            devices = self.__index.devices
+            keep = { k: d for k, d in devices.items() if d.age <= ttl or d.locked }
+            evicted = [ devices[k] for k in devices.keys() - keep.keys() ]
+            if evicted:
+                self.__index = Index(keep)
+        for device in evicted:
+            logger.info(f"Evicting {device}")
+            self.__notify(1, device)
+            self.__close(device)
+
+    def get_device(self, uid):
+        return self.__index.by_uid.get(uid)
+
+    def get_device_by_key(self, key):
+        """Device by key, e.g. serial port."""
+        return self.__index.devices.get(key)
+
+    def get_device_by_name(self, hostname):
+        index = self.__index
+        return index.by_name.get(hostname) or index.by_uid.get(Config.hostname2uid(hostname))
 
     def has_key(self, key) -> bool:
         # true if device key (hash) already stored in __devices
-        with self.__devices_lock:
-            if key in self.__devices:
-                self.__devices[key].seen()
-                return True
+        device = self.__index.devices.get(key)
+        if device:
+            device.seen()
+            return True
         return False
 
+    def __notify(self, event, device):
+        # event 0: added, 1: removed
+        for listener in self.__listeners:
+            if listener[event]:
+                try:
+                    listener[event](device)
+                except Exception as e:
+                    logger.exception(f"Error in discover listener: {e}")
+
+    def __close(self, device):
+        # release resources of device no longer in the index
+        if device.locked:
+            # in use, closed when it is garbage collected
+            return
+        try:
+            device.close()
+        except Exception as e:
+            logger.debug(f"Error closing {device}: {e}")
+
     def __enter__(self):
-        self.__devices_lock.acquire()
-        return self.__devices.values()
+        return self.__index.devices.values()
 
     def __exit__(self, type, value, traceback):
-        self.__devices_lock.release()
+        pass
+
+
+class Index:
+    """Snapshot of registered devices with lookup tables (not modified once created)."""
+
+    def __init__(self, devices):
+        # key (hash) --> device
+        self.devices = devices
+        self.by_uid = { d.uid: d for d in devices.values() if d.uid }
+        self.by_name = { Config.uid2hostname(uid): d for uid, d in self.by_uid.items() }
@@ -3,43 +3,150 @@ from .net_device import NetDevice
 from .config_store import Config
 
 import socket
+import struct
+import threading
 import json
 import time
 import logging
 
 logger = logging.getLogger(__file__)
 
+
+"""
+Devices advertised by DeviceServers on the network.
+
+scan() listens for advertisements for 4 seconds. Alternatively, start() a
+listener that updates the registry as advertisements arrive:
+
+    dn = DiscoverNet()
+    dn.start()
+    device = dn.wait_for(uid, timeout=10)
+
+Understands batched advertisements (many uids per message, devices that are
+gone are removed immediately) and the original one message per device.
+Advertisements are received on `advertise_port`, and from the multicast
+group `advertise_group` if it is configured.
+"""
+
+# maximum size of advertisement datagrams
+ADVERTISE_SIZE = 65535
+
+
 class DiscoverNet(Discover):
 
     def __init__(self):
         # find & serve devices advertised online
         super().__init__()
+        self.__listener = None
+        self.__stop = threading.Event()
+
+    @property
+    def listening(self) -> bool:
+        return self.__listener is not None
+
+    def start(self):
+        """Listen for advertisements in a background thread."""
+        if self.__listener: return
+        self.__stop.clear()
+        self.__listener = threading.Thread(target=self.__listen, name="DiscoverNet", daemon=True)
+        self.__listener.start()
+
+    def stop(self):
+        """Stop background listener."""
+        if not self.__listener: return
+        self.__stop.set()
+        self.__listener.join()
+        self.__listener = None
 
     def scan(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            # Note: port 255.255.255.255 fails with OSError: 
-            #     [Errno 49] Can't assign requested address
-            # ??? get OSError 98 when server is not running???
-            port = Config.get('advertise_port')
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.settimeout(6)
-            try:
-                s.bind(('0.0.0.0', port))
-            except:
-                logger.error("Cannot bind to port {}".format(port))
-                raise
+        if self.__listener:
+            # registry is kept up to date by the listener
+            self.evict()
+            return
+        with self.__socket(6) as s:
             start = time.monotonic()
             while (time.monotonic() - start) < 4:
                 try:
-                    msg = json.loads(s.recv(1024).decode())
-                    if msg['protocol'] != 'repl':
-                        logger.error(f"Found device with unknown protocol {msg['protocol'] (msg)}")
-                        continue
-                    logger.debug(f"Discovered {msg}")
-                    if not self.has_key(msg['uid']):
-                        self.add_device(NetDevice(msg))
+                    self.__advertised(s.recv(ADVERTISE_SIZE))
                 except socket.timeout:
                     logger.debug("Timeout in discovery")
-                except json.JSONDecodeError:
-                    logger.debug(f"Received malformed advertisement: {msg}")
- 
\ No newline at end of file
+        # remove devices no longer advertised
+        self.evict()
+
+    def __listen(self):
+        s = None
+        last_evict = time.monotonic()
+        while not self.__stop.is_set():
+            try:
+                if not s:
+                    s = self.__socket(1)
+                self.__advertised(s.recv(ADVERTISE_SIZE))
+            except socket.timeout:
+                pass
+            except OSError as e:
+                # e.g. network unreachable, try again
+                logger.error(f"Error receiving advertisements: {e}")
+                if s:
+                    s.close()
+                    s = None
+                self.__stop.wait(5)
+            if time.monotonic() - last_evict > 1:
+                self.evict()
+                last_evict = time.monotonic()
+        if s:
+            s.close()
+
+    def __socket(self, timeout):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Note: port 255.255.255.255 fails with OSError:
+        #     [Errno 49] Can't assign requested address
+        # ??? get OSError 98 when server is not running???
+        port = Config.get('advertise_port')
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.settimeout(timeout)
+        try:
+            s.bind(('0.0.0.0', port))
+        except:
+            logger.error("Cannot bind to port {}".format(port))
+            s.close()
+            raise
+        group = Config.get('advertise_group')
+        if group:
+            mreq = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return s
+
+    def __advertised(self, data):
+        # process advertisement
+        try:
+            msg = json.loads(data.decode())
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.debug(f"Received malformed advertisement: {data}")
+            return
+        if not isinstance(msg, dict):
+            logger.debug(f"Received malformed advertisement: {data}")
+            return
+        protocol = msg.get('protocol')
+        try:
+            if protocol == 'repl-batch':
+                self.__batch(msg)
+            elif protocol == 'repl':
+                logger.debug(f"Discovered {msg}")
+                if not self.has_key(msg['uid']):
+                    self.add_device(NetDevice(msg))
+            else:
+                logger.error(f"Found device with unknown protocol {protocol} ({msg})")
+        except (KeyError, TypeError, ValueError) as e:
+            # e.g. uid or ip_addr missing
+            logger.debug(f"Received malformed advertisement: {data} ({e})")
+
+    def __batch(self, msg):
+        # many devices served by one DeviceServer
+        logger.debug(f"Discovered {msg}")
+        for uid in msg.get('uids', []):
+            if not self.has_key(uid):
+                self.add_device(NetDevice({ 'uid': uid, 'ip_addr': msg['ip_addr'], 'ip_port': msg['ip_port'] }))
+        for uid in msg.get('gone', []):
+            device = self.get_device_by_key(uid)
+            if device and not device.locked:
+                self.remove_device(device)
@@ -1,15 +1,53 @@
 from .discover import Discover
+from .config_store import Config
 from .repl import ReplException
 from .serial_device import SerialDevice
+from .hotplug import Hotplug
+from .uid_cache import UidCache, usb_identity
 
 from serial import SerialException
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
+import threading
 import time
+import os
 import logging
 import serial
 import serial.tools.list_ports
 
 logger = logging.getLogger(__file__)
 
+
+"""
+Devices connected to serial ports.
+
+scan() enumerates all serial ports. Alternatively, start() watches for ports
+being plugged in or removed (Linux, see hotplug) and scan() only checks that
+the ports of known devices still exist:
+
+    ds = DiscoverSerial()
+    ds.start()
+    device = ds.wait_for(uid, timeout=10)
+
+If hotplug events are not available, start() does nothing and scan() keeps
+enumerating ports.
+
+New ports are probed (opened and asked for their uid) concurrently by up to
+`serial_probe_workers` threads. scan() waits at most `serial_probe_timeout`
+seconds for them, slower probes add their device when they complete. Ports
+that fail are not probed again for `serial_probe_backoff` seconds, doubling
+with each failure up to `serial_probe_backoff_max`.
+
+Uids found by probing are cached by USB identity (see uid_cache). Ports with
+a cached uid are registered without probing, the uid is checked on first use
+(SerialDevice). Ports are probed if their identity is not unique (e.g. USB
+adapters without serial numbers) or the cached uid turns out wrong.
+
+Devices behind UART bridges negotiate their baudrate (see SerialDevice)
+in the probe threads, after probing or when scan() finds a device that was
+used at the default rate, never while a client is waiting for the device.
+"""
+
 # Vendor IDs
 ADAFRUIT_VID = 0x239A  # Adafruit board
 PARTICLE_VID = 0x2B04  # Particle
@@ -18,23 +56,188 @@ STM32_VID    = 0xf055  # STM32 usb port
 
 COMPATIBLE_VID = { ADAFRUIT_VID, PARTICLE_VID, STM32_VID, ESP32_VID }
 
+# USB to UART bridges, other devices have native USB (with flow control)
+UART_BRIDGE_VID = { ESP32_VID }
+
 
 class DiscoverSerial(Discover):
 
     def __init__(self):
         super().__init__()
+        self.__hotplug = None
+        self.__watcher = None
+        self.__executor = ThreadPoolExecutor(max_workers=Config.get('serial_probe_workers', 8),
+                                             thread_name_prefix="Probe")
+        self.__probe_lock = threading.Lock()
+        # ports being probed (or negotiating their baudrate)
+        self.__probing = set()
+        # port --> (failures, time of next probe, port info)
+        self.__failed = {}
+        self.__uids = UidCache()
+        # port --> port info of registered devices
+        self.__ports = {}
+
+    @property
+    def hotplug(self) -> bool:
+        """True if ports are found by hotplug events rather than scanning."""
+        return self.__hotplug is not None
+
+    def start(self):
+        """Watch for serial ports in a background thread."""
+        if self.__hotplug: return
+        try:
+            self.__hotplug = Hotplug()
+        except OSError as e:
+            logger.info(f"Hotplug not available, scanning serial ports: {e}")
+            return
+        self.__watcher = threading.Thread(target=self.__watch, name="DiscoverSerial", daemon=True)
+        self.__watcher.start()
+
+    def stop(self):
+        """Stop watching for ports."""
+        if not self.__hotplug: return
+        self.__hotplug.interrupt()
+        self.__watcher.join()
+        self.__hotplug.close()
+        self.__hotplug = None
+        self.__watcher = None
 
     def scan(self):
-        # scan & replicate serial ports
+        if self.__hotplug:
+            # ports are added by the watcher, unplugged devices are evicted
+            with self as devices:
+                for dev in devices:
+                    if os.path.exists(dev.__hash__()):
+                        dev.seen()
+            # ports that failed before
+            with self.__probe_lock:
+                retry = [ f[2] for f in self.__failed.values() ]
+            for port in retry:
+                self.__add(port)
+        else:
+            wait(self.__scan(), timeout=Config.get('serial_probe_timeout', 10))
+        self.evict()
+        with self as devices:
+            for dev in devices:
+                if dev.needs_baudrate and not dev.locked:
+                    self.__negotiate(dev)
+
+    def __scan(self):
+        # scan & replicate serial ports, returns futures of probes started
+        futures = []
         try:
-            for port in serial.tools.list_ports.comports():
-                if port.vid in COMPATIBLE_VID:
-                    if not self.has_key(port.device):
-                        logger.debug(f"Found {port.device}")
-                        dev = SerialDevice(port.device, f"{port.product} by {port.manufacturer}")
-                        self.add_device(dev)
-                elif port.vid:
-                    logger.info("Found {} with unknown VID {:02X} (ignored)".format(port, port.vid))
+            ports = serial.tools.list_ports.comports()
+            identities = [ usb_identity(port) for port in ports ]
+            for port, identity in zip(ports, identities):
+                f = self.__add(port, identities.count(identity) == 1)
+                if f: futures.append(f)
+            # forget failures of unplugged ports
+            present = { port.device for port in ports }
+            with self.__probe_lock:
+                for device in self.__failed.keys() - present:
+                    del self.__failed[device]
         except Exception as e:
             logger.exception(f"Error in scan: {e}")
+        return futures
+
+    def __add(self, port, unique=True):
+        # probe port unless it is known, being probed, or backing off
+        if port.vid in COMPATIBLE_VID:
+            if self.has_key(port.device):
+                return None
+            with self.__probe_lock:
+                if port.device in self.__probing:
+                    return None
+                failed = self.__failed.get(port.device)
+                if failed and failed[1] > time.monotonic():
+                    return None
+                self.__probing.add(port.device)
+            logger.debug(f"Found {port.device}")
+            return self.__executor.submit(self.__probe, port, unique)
+        elif port.vid:
+            logger.info("Found {} with unknown VID {:02X} (ignored)".format(port, port.vid))
+        return None
+
+    def __probe(self, port, unique=True):
+        try:
+            identity = usb_identity(port) if unique else None
+            uid = self.__uids.get(identity)
+            if uid and self.get_device(uid):
+                # registered on another port
+                uid = None
+            dev = SerialDevice(port.device, f"{port.product} by {port.manufacturer}",
+                               uid=uid, mismatch=functools.partial(self.__mismatch, port),
+                               native_usb=port.vid not in UART_BRIDGE_VID)
+            if not uid:
+                other = self.get_device(dev.uid)
+                if other and other.__hash__() in self.__ports:
+                    # uid cached for the other port is wrong (or the device moved)
+                    self.__mismatch(self.__ports[other.__hash__()], other, dev.uid)
+                self.__uids.put(identity, dev.uid)
+                self.__uids.save()
+            # the device is interrupted anyway, before clients can use it
+            dev.negotiate_baudrate()
+            with self.__probe_lock:
+                self.__failed.pop(port.device, None)
+                self.__ports[port.device] = port
+            self.add_device(dev)
+        except Exception as e:
+            with self.__probe_lock:
+                failures = self.__failed.get(port.device, (0, ))[0] + 1
+                delay = min(Config.get('serial_probe_backoff', 2) * 2**(failures-1),
+                            Config.get('serial_probe_backoff_max', 300))
+                self.__failed[port.device] = (failures, time.monotonic() + delay, port)
+            logger.info(f"Probing {port.device} failed ({e}), retry in {delay}s")
+        finally:
+            with self.__probe_lock:
+                self.__probing.discard(port.device)
+
+    def __negotiate(self, dev):
+        # negotiate baudrate in a probe thread
+        port = dev.__hash__()
+        with self.__probe_lock:
+            if port in self.__probing:
+                return
+            self.__probing.add(port)
+        def negotiate():
+            try:
+                dev.negotiate_baudrate()
+            finally:
+                with self.__probe_lock:
+                    self.__probing.discard(port)
+        self.__executor.submit(negotiate)
+
+    def __mismatch(self, port, device, uid):
+        # device on port is not the one registered, probe port again
+        logger.info(f"{device.uid} not at {port.device} ({uid} found), probing again")
+        self.__uids.forget(usb_identity(port))
+        self.__uids.save()
+        with self.__probe_lock:
+            self.__ports.pop(port.device, None)
+        self.remove_device(device)
+        self.__add(port)
 
+    def __watch(self):
+        # ports already connected
+        self.__scan()
+        while True:
+            events = self.__hotplug.wait()
+            if events is None:
+                return
+            for action, port in events:
+                try:
+                    if action == 'add':
+                        from serial.tools.list_ports_linux import SysFS
+                        self.__add(SysFS(port))
+                    elif action == 'remove':
+                        with self.__probe_lock:
+                            self.__failed.pop(port, None)
+                            self.__ports.pop(port, None)
+                        dev = self.get_device_by_key(port)
+                        if dev and not dev.locked:
+                            logger.debug(f"Removed {port}")
+                            self.remove_device(dev)
+                    else:
+                        self.__scan()
+                except Exception as e:
+                    logger.info(f"Cannot add {port}: {e}")
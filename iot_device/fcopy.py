@@ -1,8 +1,12 @@
-from .repl import Repl, BUFFER_SIZE
+from .repl import Repl, ReplException, BUFFER_SIZE, MCU_ABORT, EOT
 from .config_store import Config
 
 import binascii
+import functools
 import os
+import re
+import time
+import zlib
 import logging
 
 logger = logging.getLogger(__file__)
@@ -11,9 +15,80 @@ logger = logging.getLogger(__file__)
 """
 Device with added features:
 * fget, fput - copy files between host and remote device
+* fput_batch - upload many files in one eval
+* fpatch - update a file, sending only the parts that changed
 * file_size
+
+Transfers use a sliding window protocol: up to `xfer_window` frames are in
+flight before the receiver acknowledges. Each frame has a 10 character hex
+header (sequence number, payload length, checksum) so lost or garbled frames
+are detected. Acks are cumulative: b'\x06' followed by the hex sequence
+number of the last frame received, b'\x15' (NAK) signals a lost or garbled
+frame, b'\x07' (BEL) any other error on the MCU (e.g. the file cannot be
+written). The default window depends on the MCU's platform (XFER_WINDOWS).
+A window of 0 selects the original stop-and-wait protocol (one ack per
+BUFFER_SIZE chunk). Devices that lose frames or acks (XferError) fall back
+to it.
+
+fput_batch sends a whole change set (deletions, directories, files) to the
+MCU in a single eval. Each operation is a command line (followed by frames
+for files) and the MCU reports its status.
+
+Binary files (content that could upset the REPL, e.g. ctrl-C) are encoded
+for upload:
+* 'esc' - raw bytes, only ESCAPED bytes are sent as DLE followed by
+          byte ^ 0x40 (requires sys.stdin.buffer on the MCU)
+* 'b64' - base64 (requires binascii)
+* 'hex' - hexlify, doubles the size (the stop-and-wait protocol always uses this)
+
+Files are compressed if the MCU has a decompressor (`decompressor`) and this
+shrinks the upload. The file is split into COMPRESS_BLOCK sized blocks, each
+compressed separately (raw deflate) and sent with a 2 byte length prefix, so
+the MCU decompresses one block at a time.
+
+fpatch uses the rsync algorithm: the MCU reports checksums of the blocks of
+its copy of the file (weak: sum of bytes, strong: crc32). The host rolls the
+weak checksum over the new file and sends a delta, copy instructions for
+blocks that match and literal data for the rest. The MCU rebuilds the file
+from the delta and its old copy in a temporary file that replaces the original.
 """
 
+ACK = b'\x06'
+NAK = b'\x15'
+BEL = b'\x07'
+BATCH_STATUS = b'\x11'
+
+# frames in flight, by sys.platform of the MCU
+# esp32 and esp8266 buffer no more than about 255 bytes of input (one frame)
+XFER_WINDOW = 4
+XFER_WINDOWS = { 'esp32': 1, 'esp8266': 1 }
+
+# frame header: 2 hex digits sequence number, 4 payload size, 4 checksum
+FRAME_HEADER_SIZE = 10
+FRAME_PAYLOAD_SIZE = BUFFER_SIZE - FRAME_HEADER_SIZE
+
+# control characters other than \a\b\f\n\t\v
+BINARY = re.compile(b'[\x00-\x06\x0d-\x1f]')
+
+# raw REPL control characters (ctrl-A ... ctrl-E) and the escape character (DLE)
+ESCAPED = re.compile(b'[\x01-\x05\x10]')
+
+# compression: bytes per block (decompressed on the MCU in one piece),
+# smaller files are sent uncompressed
+COMPRESS_BLOCK = 4096
+COMPRESS_MIN = 256
+
+# deflate window bits (2**12 = COMPRESS_BLOCK bytes), _mcu_put decompresses with the same
+COMPRESS_WBITS = 12
+
+# approximate size on the wire / size of data, by encoding
+EXPANSION = { 'esc': 1.02, 'b64': 4/3, 'hex': 2, None: 1 }
+
+
+class XferError(ReplException):
+    """Frames or acks lost or garbled during a windowed transfer."""
+    pass
+
 
 class Fcopy(Repl):
 
@@ -32,27 +107,196 @@ class Fcopy(Repl):
     def cat(self, output, filename):
         self.eval_func(_cat, filename, output=output)
 
+    @property
+    def xfer_window(self):
+        """Number of frames in flight during fget/fput, 0 for stop-and-wait.
+        Set per device with `xfer_window` in hosts.py or globally in config.py,
+        default from the MCU's platform (XFER_WINDOWS).
+        """
+        negotiated = self.device.negotiated
+        if 'xfer_window' not in negotiated:
+            window = Config.host_setting(self.device.uid, 'xfer_window')
+            if window is None:
+                platform = self.device_characteristics().get('platform')
+                window = XFER_WINDOWS.get(platform, XFER_WINDOW)
+            # sequence numbers are mod 256
+            negotiated['xfer_window'] = max(0, min(int(window), 127))
+        return negotiated['xfer_window']
+
+    @property
+    def binary_encoding(self):
+        """Encoding of binary files for windowed uploads, 'esc', 'b64' or 'hex'.
+        Override with `binary_encoding` in hosts.py or config.py.
+        """
+        negotiated = self.device.negotiated
+        if 'binary_encoding' not in negotiated:
+            encoding = Config.host_setting(self.device.uid, 'binary_encoding')
+            if not encoding:
+                dc = self.device_characteristics()
+                if dc['has_buffer']:
+                    encoding = 'esc'
+                elif dc['has_binascii']:
+                    encoding = 'b64'
+                else:
+                    encoding = 'hex'
+            negotiated['binary_encoding'] = encoding
+        return negotiated['binary_encoding']
+
+    @property
+    def delta_min(self):
+        """Files of at least this size are updated with a delta (fpatch), 0 disables.
+        Set per device with `xfer_delta_min` in hosts.py or globally in config.py.
+        """
+        return Config.host_setting(self.device.uid, 'xfer_delta_min', 16384)
+
+    @property
+    def decompressor(self):
+        """MCU module for decompressing uploads ('zlib', 'uzlib', 'deflate') or None.
+        Disable compression with `xfer_compress = False` in hosts.py or config.py.
+        """
+        negotiated = self.device.negotiated
+        if 'decompressor' not in negotiated:
+            decompressor = None
+            if Config.host_setting(self.device.uid, 'xfer_compress', True):
+                decompressor = self.device_characteristics().get('decompress')
+            negotiated['decompressor'] = decompressor
+        return negotiated['decompressor']
+
     def fget(self, remote_file, local_file):
         filesize = self.file_size(remote_file)
         if filesize < 0:
             return False
+        window = self.xfer_window
+        if window > 0:
+            try:
+                return self.eval_func(_mcu_get, remote_file, local_file, filesize, window, xfer_func=_host_get)
+            except XferError as e:
+                self.__fallback(e)
         return self.eval_func(_mcu_read, remote_file, local_file, filesize, xfer_func=_host_write)
 
     def fput(self, local_file, remote_file):
         # upload file to MCU
-        if os.path.isdir(local_file):
+        # local_file is relative to host_dir
+        src_file_name = os.path.join(os.path.expanduser(Config.get('host_dir')), local_file)
+        if os.path.isdir(src_file_name):
             # Copy files only, not directories
             return False
-        with open(local_file, 'rb') as f:
-            # Check if it's a binary file that could upset REPL (ctrl-C, ...)
-            include = [ord(x) for x in '\a\b\f\n\t\v']
-            exclude = bytes([ x for x in range(32) if not x in include ])
-            binary = any([x in exclude for x in f.read()])
-        filesize = os.path.getsize(local_file)
+        st = os.stat(src_file_name)
+        data, binary = _host_file(src_file_name, st.st_mtime_ns, st.st_size)
         self.makedirs(os.path.dirname(remote_file))
-        res = self.eval_func(_mcu_write, local_file, remote_file, filesize, binary, xfer_func=_host_read)
+        window = self.xfer_window
+        if window > 0:
+            filesize, encoding, decompressor = self.__upload(src_file_name, st)
+            try:
+                return self.eval_func(_mcu_put, local_file, remote_file, filesize, encoding, window, decompressor,
+                                      xfer_func=_host_put)
+            except XferError as e:
+                self.__fallback(e)
+        res = self.eval_func(_mcu_write, local_file, remote_file, len(data), binary, xfer_func=_host_read)
         return res
 
+    def fpatch(self, local_file, remote_file):
+        """Update remote_file, sending only the parts that differ from local_file.
+        Small files, and files for which the delta saves little, are sent with fput.
+        """
+        src_file_name = os.path.join(os.path.expanduser(Config.get('host_dir')), local_file)
+        if os.path.isdir(src_file_name):
+            return False
+        st = os.stat(src_file_name)
+        if not self.delta_min or st.st_size < self.delta_min or self.xfer_window == 0:
+            return self.fput(local_file, remote_file)
+        data, _ = _host_file(src_file_name, st.st_mtime_ns, st.st_size)
+        block = Config.host_setting(self.device.uid, 'xfer_delta_block', 512)
+        try:
+            sums = self.eval_func(_mcu_block_sums, remote_file, block) or ''
+        except ReplException as e:
+            logger.info(f"fpatch {remote_file}: no block checksums ({e}), sending whole file")
+            return self.fput(local_file, remote_file)
+        sums = [ tuple(int(x, 16) for x in line.split(',')) for line in sums.split() ]
+        delta = _host_delta(data, sums, block)
+        logger.debug(f"fpatch {remote_file}: delta {len(delta)} bytes, file {len(data)} bytes")
+        if len(delta) > 0.8 * len(data):
+            return self.fput(local_file, remote_file)
+        # deltas differ per device, they are not cached like host files
+        encoding = self.binary_encoding
+        frames = tuple(_encode(delta, encoding))
+        window = self.xfer_window
+        try:
+            self.eval_func(_mcu_put, None, remote_file + '.delta', len(delta), encoding, window,
+                           xfer_func=lambda device, *args: _host_send(device, frames, window))
+            return self.eval_func(_mcu_patch, remote_file, remote_file + '.delta', block, len(data)) == 'True'
+        except XferError as e:
+            self.__fallback(e)
+            return self.fput(local_file, remote_file)
+        except ReplException as e:
+            logger.warning(f"fpatch {remote_file} failed ({e}), sending whole file")
+            return self.fput(local_file, remote_file)
+
+    def fput_batch(self, files=(), makedirs=(), deletes=()):
+        """Delete paths (recursively), create directories and upload files in a single eval.
+           files: list of (local_file, remote_file), local_file is relative to host_dir
+        Returns dict remote path -> True if successful, False otherwise.
+        A failed upload ends the eval, the remaining operations continue in a new one.
+        """
+        host_dir = os.path.expanduser(Config.get('host_dir'))
+        ops = [ ('D', path) for path in deletes ]
+        dirs = set(makedirs)
+        uploads = []
+        for local_file, remote_file in files:
+            src_file_name = os.path.join(host_dir, local_file)
+            if os.path.isdir(src_file_name):
+                # Copy files only, not directories
+                continue
+            st = os.stat(src_file_name)
+            filesize, encoding, decompressor = self.__upload(src_file_name, st)
+            uploads.append(('F', remote_file, filesize, encoding, decompressor, local_file))
+            if os.path.dirname(remote_file):
+                dirs.add(os.path.dirname(remote_file))
+        ops += [ ('M', path) for path in sorted(dirs) ]
+        ops += uploads
+        window = self.xfer_window
+        if window == 0:
+            # stop-and-wait device, one eval per operation
+            res = {}
+            for op in ops:
+                if op[0] == 'D':
+                    res[op[1]] = self.rm_rf(op[1], recursive=True) == 'True'
+                elif op[0] == 'M':
+                    res[op[1]] = self.makedirs(op[1]) == 'True'
+                else:
+                    res[op[1]] = self.fput(op[5], op[1]) is not False
+            return res
+        status = []
+        while len(status) < len(ops):
+            done = len(status)
+            remaining = ops[done:]
+            try:
+                self.eval_func(_mcu_batch, len(remaining), window,
+                               xfer_func=functools.partial(_host_batch, ops=remaining, status=status, done=done),
+                               requires=(_rm_rf, _makedirs, _mcu_put))
+            except ReplException as e:
+                if len(status) == done:
+                    raise
+                logger.warning(f"Upload of {ops[len(status)-1][1]} to {self.device.uid} failed: {e}")
+        return { op[1]: ok for op, ok in zip(ops, status) }
+
+    def __upload(self, src_file_name, st):
+        # size, encoding and decompressor for uploading file with _mcu_put
+        data, binary = _host_file(src_file_name, st.st_mtime_ns, st.st_size)
+        encoding = self.binary_encoding if binary else None
+        decompressor = self.decompressor
+        if decompressor and st.st_size >= COMPRESS_MIN:
+            stream = _host_deflate(src_file_name, st.st_mtime_ns, st.st_size)
+            # compressed data is binary, use it if it saves at least 10% on the wire
+            if len(stream) * EXPANSION[self.binary_encoding] < 0.9 * st.st_size * EXPANSION[encoding]:
+                return len(stream), self.binary_encoding, decompressor
+        return st.st_size, encoding, None
+
+    def __fallback(self, e):
+        # frames or acks lost, e.g. device input buffer overrun
+        logger.warning(f"Windowed transfer with {self.device.uid} failed ({e}), using stop-and-wait")
+        self.device.negotiated['xfer_window'] = 0
+
 
 ##########################################################################
 # Code running on MCU
@@ -153,6 +397,431 @@ def _host_write(device, remote_file, local_file, filesize):
             bytes_remaining -= read_size
 
 
+def _mcu_put(local_file, remote_file, filesize, encoding, window, decompressor=None):
+    # receives file from host in frames and writes to flash as `remote_file`
+    # with decompressor, filesize is the size of the compressed stream
+    # matches up with _host_put
+    import sys
+    stdin = sys.stdin.buffer if encoding == 'esc' else sys.stdin
+    def read_into(buf, size):
+        mv = memoryview(buf)
+        index = 0
+        while index < size:
+            n = stdin.readinto(mv[index:size], size-index)  # pylint: disable=no-member
+            if n: index += n
+    def unescape(data):
+        res = bytearray()
+        i = 0
+        while True:
+            j = data.find(b'\x10', i)
+            if j < 0:
+                res.extend(data[i:])
+                return res
+            res.extend(data[i:j])
+            res.append(data[j+1] ^ 0x40)
+            i = j + 2
+    def inflate(block):
+        # decompress raw deflate block, 4 KB window (COMPRESS_WBITS)
+        if decompressor == 'deflate':
+            import deflate, io
+            return deflate.DeflateIO(io.BytesIO(block), deflate.RAW, 12).read()
+        return __import__(decompressor).decompress(block, -12)
+    try:
+        if encoding in ('hex', 'b64'):
+            import binascii
+        ack_every = max(1, window // 2)
+        header = bytearray(10)
+        buf = bytearray(BUFFER_SIZE)
+        seq = 0
+        # compressed blocks, 2 byte length followed by deflate data
+        pending = bytearray()
+        # error receiving a frame (NAK), rather than processing it (BEL)
+        framing = False
+        with open(remote_file, 'wb') as dst_file:
+            bytes_remaining = filesize
+            while bytes_remaining > 0:
+                framing = True
+                read_into(header, 10)
+                h = bytes(header).decode()
+                size = int(h[2:6], 16)
+                if int(h[0:2], 16) != seq or size > BUFFER_SIZE:
+                    raise ValueError("frame {}: bad header {}".format(seq, h))
+                read_into(buf, size)
+                payload = memoryview(buf)[0:size]
+                if sum(payload) & 0xffff != int(h[6:10], 16):
+                    raise ValueError("frame {}: checksum error".format(seq))
+                framing = False
+                if encoding == 'hex':
+                    data = binascii.unhexlify(payload)
+                elif encoding == 'b64':
+                    data = binascii.a2b_base64(payload)
+                elif encoding == 'esc':
+                    data = bytes(payload)
+                    if b'\x10' in data:
+                        data = unescape(data)
+                else:
+                    data = payload
+                bytes_remaining -= len(data)
+                if decompressor:
+                    pending.extend(data)
+                    while len(pending) >= 2 and len(pending) >= 2 + (pending[0] << 8 | pending[1]):
+                        n = 2 + (pending[0] << 8 | pending[1])
+                        dst_file.write(inflate(bytes(pending[2:n])))
+                        pending = pending[n:]
+                else:
+                    dst_file.write(data)
+                # cumulative ack as a form of flow control
+                if seq % ack_every == ack_every-1 or bytes_remaining <= 0:
+                    sys.stdout.write('\x06{:02x}'.format(seq))
+                seq = (seq + 1) & 0xff
+    except:
+        # signal error (anything but b'\x06')
+        sys.stdout.write(('\x15' if framing else '\x07') + '{:02x}'.format(seq))
+        raise
+
+def _host_put(device, local_file, remote_file, filesize, encoding, window, decompressor=None):
+    # reads file from host and sends to MCU
+    # pass to `ReplOps.eval_func` as the xfer_func argument
+    # matches up with _mcu_put
+    host_dir = os.path.expanduser(Config.get('host_dir'))
+    src_file_name = os.path.join(host_dir, local_file)
+    st = os.stat(src_file_name)
+    frames = _host_frames(src_file_name, st.st_mtime_ns, st.st_size, encoding, bool(decompressor))
+    return _host_send(device, frames, window)
+
+def _host_send(device, frames, window):
+    # sends frame payloads to _mcu_put, waits for acks when the window is full
+    sent = acked = 0
+    start = time.monotonic()
+    size = 0
+    for buf in frames:
+        device.write(_frame_header(sent, buf) + buf)
+        sent += 1
+        size += len(buf)
+        # wait for acks only when the window is full
+        while sent - acked >= window:
+            acked = _wait_ack(device, acked)
+    while acked < sent:
+        acked = _wait_ack(device, acked)
+    if sent > 2 * window:
+        # long enough to measure how fast the device consumes data
+        device.drained(size, time.monotonic() - start)
+    return True
+
+def _mcu_get(remote_file, local_file, filesize, window):
+    # reads file from flash and sends to host in frames
+    # matches up with _host_get
+    import sys
+    ack_every = max(1, window // 2)
+    ack = bytearray(3)
+    buf = bytearray(BUFFER_SIZE - 10)
+    sent = acked = 0
+    with open(remote_file, 'rb') as src_file:
+        bytes_remaining = filesize
+        while bytes_remaining > 0 or acked < sent:
+            if bytes_remaining > 0 and sent - acked < window:
+                size = src_file.readinto(buf, min(bytes_remaining, len(buf)))
+                if not size:
+                    raise ValueError("{} truncated".format(remote_file))
+                payload = memoryview(buf)[0:size]
+                header = '{:02x}{:04x}{:04x}'.format(sent & 0xff, size, sum(payload) & 0xffff)
+                # buffer is necessary!
+                sys.stdout.buffer.write(header.encode())
+                sys.stdout.buffer.write(payload)
+                sent += 1
+                bytes_remaining -= size
+            else:
+                # wait for (cumulative) ack from host
+                index = 0
+                while index < 3:
+                    n = sys.stdin.readinto(memoryview(ack)[index:], 3-index)  # pylint: disable=no-member
+                    if n: index += n
+                if ack[0] != 6:
+                    raise ValueError("Expected '\\x06', got '{}'".format(ack[0]))
+                acked += ((int(bytes(ack[1:3]), 16) - acked) & 0xff) + 1
+
+def _host_get(device, remote_file, local_file, filesize, window):
+    # receives file from MCU and saves on host
+    # pass to `ReplOps.eval_func` as the xfer_func argument
+    # matches up with _mcu_get
+    host_dir = os.path.expanduser(Config.get('host_dir'))
+    dst_file_name = os.path.join(host_dir, local_file)
+    ack_every = max(1, window // 2)
+    seq = 0
+    with open(dst_file_name, 'wb') as dst_file:
+        bytes_remaining = filesize
+        while bytes_remaining > 0:
+            header = _read_exact(device, FRAME_HEADER_SIZE)
+            try:
+                frame_seq, size, checksum = int(header[0:2], 16), int(header[2:6], 16), int(header[6:10], 16)
+            except ValueError:
+                frame_seq = size = checksum = -1
+            if frame_seq != seq & 0xff or not 0 < size <= FRAME_PAYLOAD_SIZE:
+                _abort(device, f"frame {seq}: bad header {header}", header)
+            buf = _read_exact(device, size)
+            if sum(buf) & 0xffff != checksum:
+                _abort(device, f"frame {seq}: checksum error")
+            dst_file.write(buf)
+            bytes_remaining -= size
+            if seq % ack_every == ack_every-1 or bytes_remaining <= 0:
+                device.write(ACK + b'%02x' % (seq & 0xff))
+            seq += 1
+    return True
+
+def _mcu_batch(count, window):
+    # receives count operations from host, one command line each:
+    #    D,path                      rm -rf path
+    #    M,path                      makedirs path
+    #    F,filesize,encoding,decompressor,path
+    #                                followed by the file in frames (see _mcu_put)
+    # and reports the status of each (DC1 followed by 1 or 0)
+    # matches up with _host_batch
+    import sys
+    b = bytearray(1)
+    for _ in range(count):
+        line = bytearray()
+        while True:
+            n = sys.stdin.readinto(b, 1)  # pylint: disable=no-member
+            if not n: continue
+            if b[0] == 10: break
+            line.extend(b)
+        op, arg = bytes(line).decode().split(',', 1)
+        if op == 'D':
+            ok = _rm_rf(arg, True)
+        elif op == 'M':
+            ok = _makedirs(arg)
+        else:
+            filesize, encoding, decompressor, path = arg.split(',', 3)
+            # raises (ending the batch) if the transfer fails
+            _mcu_put(None, path, int(filesize), encoding or None, window, decompressor or None)
+            ok = True
+        sys.stdout.write('\x11' + ('1' if ok else '0'))
+
+def _host_batch(device, count, window, ops, status, done=0):
+    # sends operations to MCU and appends their status (True/False) to status
+    # pass to `ReplOps.eval_func` (with ops, status and done bound) as the xfer_func argument
+    # matches up with _mcu_batch
+    # status of earlier operations (done), eval_func may call this again for the same ops
+    del status[done:]
+    for op in ops[:count]:
+        if op[0] == 'F':
+            _, remote_file, filesize, encoding, decompressor, local_file = op
+            device.write(f"F,{filesize},{encoding or ''},{decompressor or ''},{remote_file}\n".encode())
+            try:
+                _host_put(device, local_file, remote_file, filesize, encoding, window, decompressor)
+            except ReplException:
+                status.append(False)
+                raise
+        else:
+            device.write(f"{op[0]},{op[1]}\n".encode())
+        # deleting a directory tree may take a while
+        res = _read_exact(device, 2, timeout=30)
+        if res[0:1] != BATCH_STATUS:
+            _abort(device, f"got {bytes(res)}, expected batch status", res)
+        status.append(res[1:2] == b'1')
+    return True
+
+def _mcu_block_sums(remote_file, block):
+    # weak (sum of bytes) and strong (crc32) checksum of each full block
+    from binascii import crc32
+    buf = bytearray(block)
+    with open(remote_file, 'rb') as f:
+        while f.readinto(buf) == block:
+            print('{:x},{:x}'.format(sum(buf), crc32(buf) & 0xffffffff))
+
+def _mcu_patch(remote_file, delta_file, block, filesize):
+    # rebuild remote_file from its blocks and literal data in delta_file:
+    #    C + 4 byte block index + 4 byte number of blocks    copy blocks
+    #    L + 4 byte size + data                              literal data
+    # matches up with _host_delta
+    import os
+    tmp_file = remote_file + '.tmp'
+    backup_file = remote_file + '.bak'
+    buf = bytearray(max(block, BUFFER_SIZE))
+    try:
+        with open(remote_file, 'rb') as old, open(delta_file, 'rb') as delta, open(tmp_file, 'wb') as new:
+            size = 0
+            while True:
+                op = delta.read(5)
+                if not op: break
+                n = int.from_bytes(op[1:5], 'big')
+                if op[0] == 67:
+                    # 'C'
+                    old.seek(n * block)
+                    n = int.from_bytes(delta.read(4), 'big') * block
+                    src = old
+                else:
+                    src = delta
+                while n > 0:
+                    k = src.readinto(memoryview(buf)[0:min(n, len(buf))])
+                    if not k:
+                        raise ValueError("{}: unexpected end of data".format(remote_file))
+                    new.write(memoryview(buf)[0:k])
+                    size += k
+                    n -= k
+        if size != filesize:
+            raise ValueError("{}: size {} after patch, expected {}".format(remote_file, size, filesize))
+        try:
+            os.rename(tmp_file, remote_file)
+        except OSError:
+            # some filesystems do not replace existing files,
+            # keep the original until the new version is in place
+            os.rename(remote_file, backup_file)
+            try:
+                os.rename(tmp_file, remote_file)
+            except OSError:
+                os.rename(backup_file, remote_file)
+                raise
+            try:
+                os.remove(backup_file)
+            except OSError:
+                pass
+    finally:
+        for f in (tmp_file, delta_file):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+    return True
+
+def _host_delta(data, sums, block):
+    # delta of data against file with block checksums sums (from _mcu_block_sums)
+    # matches up with _mcu_patch
+    blocks = {}
+    for i, (weak, strong) in enumerate(sums):
+        blocks.setdefault(weak, []).append((strong, i))
+    delta = bytearray()
+    copy = None    # [first block, number of blocks]
+    def flush(literal_start, literal_end):
+        nonlocal copy
+        if copy:
+            delta.extend(b'C' + copy[0].to_bytes(4, 'big') + copy[1].to_bytes(4, 'big'))
+            copy = None
+        if literal_end > literal_start:
+            delta.extend(b'L' + (literal_end - literal_start).to_bytes(4, 'big'))
+            delta.extend(data[literal_start:literal_end])
+    literal_start = pos = 0
+    weak = sum(data[0:block])
+    while pos + block <= len(data):
+        match = None
+        candidates = blocks.get(weak)
+        if candidates:
+            strong = zlib.crc32(data[pos:pos+block])
+            match = next((i for s, i in candidates if s == strong), None)
+        if match is not None:
+            if pos > literal_start or not copy or copy[0] + copy[1] != match:
+                flush(literal_start, pos)
+                copy = [match, 0]
+            copy[1] += 1
+            pos += block
+            literal_start = pos
+            weak = sum(data[pos:pos+block])
+        else:
+            # roll weak checksum one byte
+            if pos + block < len(data):
+                weak += data[pos+block] - data[pos]
+            pos += 1
+    flush(literal_start, len(data))
+    return bytes(delta)
+
+# Content and encoded frames of host files are cached, so uploading the same
+# file to several devices (e.g. with Fleet) reads and encodes it only once.
+
+@functools.lru_cache(maxsize=64)
+def _host_file(src_file_name, mtime_ns, size):
+    """Content of file and True if it is binary (could upset REPL, ctrl-C, ...)."""
+    with open(src_file_name, 'rb') as f:
+        data = f.read()
+    return data, BINARY.search(data) is not None
+
+@functools.lru_cache(maxsize=64)
+def _host_deflate(src_file_name, mtime_ns, size):
+    """Content of file compressed in blocks of COMPRESS_BLOCK bytes."""
+    data, _ = _host_file(src_file_name, mtime_ns, size)
+    stream = bytearray()
+    for start in range(0, len(data), COMPRESS_BLOCK):
+        c = zlib.compressobj(9, zlib.DEFLATED, -COMPRESS_WBITS)
+        block = c.compress(data[start:start+COMPRESS_BLOCK]) + c.flush()
+        stream += len(block).to_bytes(2, 'big') + block
+    return bytes(stream)
+
+@functools.lru_cache(maxsize=64)
+def _host_frames(src_file_name, mtime_ns, size, encoding, compressed=False):
+    """Payloads of frames for uploading file (or its compressed stream)."""
+    if compressed:
+        data = _host_deflate(src_file_name, mtime_ns, size)
+    else:
+        data, _ = _host_file(src_file_name, mtime_ns, size)
+        data = data[:size]
+    return tuple(_encode(data, encoding))
+
+def _encode(data, encoding):
+    # split data into frame payloads of at most FRAME_PAYLOAD_SIZE bytes
+    if encoding == 'esc':
+        start = 0
+        while start < len(data):
+            size = FRAME_PAYLOAD_SIZE
+            while True:
+                chunk = data[start:start+size]
+                buf = ESCAPED.sub(lambda m: bytes([0x10, m.group()[0] ^ 0x40]), chunk)
+                if len(buf) <= FRAME_PAYLOAD_SIZE: break
+                # each raw byte takes 1 or 2 bytes on the wire
+                size -= (len(buf) - FRAME_PAYLOAD_SIZE + 1) // 2
+            start += len(chunk)
+            yield buf
+        return
+    if encoding == 'hex':
+        size = FRAME_PAYLOAD_SIZE // 2
+        encode = binascii.hexlify
+    elif encoding == 'b64':
+        size = FRAME_PAYLOAD_SIZE // 4 * 3
+        encode = lambda b: binascii.b2a_base64(b, newline=False)
+    else:
+        size = FRAME_PAYLOAD_SIZE
+        encode = bytes
+    for start in range(0, len(data), size):
+        yield encode(data[start:start+size])
+
+def _frame_header(seq, payload):
+    return b'%02x%04x%04x' % (seq & 0xff, len(payload), sum(payload) & 0xffff)
+
+def _wait_ack(device, acked):
+    # wait for cumulative ack from MCU, returns number of frames acknowledged
+    ack = _read_exact(device, 3)
+    if ack[0:1] == NAK:
+        _abort(device, f"frame {bytes(ack[1:3]).decode()} rejected by device")
+    if ack[0:1] == BEL:
+        _abort(device, "transfer failed on device", ack)
+    if ack[0:1] != ACK:
+        _abort(device, f"got {bytes(ack)}, expected b'\\x06'", ack)
+    return acked + ((int(ack[1:3], 16) - acked) & 0xff) + 1
+
+def _read_exact(device, size, timeout=5):
+    res = bytearray()
+    start = time.monotonic()
+    while len(res) < size:
+        if (time.monotonic() - start) > timeout:
+            _abort(device, f"timeout, got {bytes(res)}", res)
+        res.extend(device.read(size-len(res)))
+    return res
+
+def _abort(device, msg, received=b''):
+    # interrupt code running on the MCU and report failed transfer
+    # received: unexpected data from the MCU, BEL or EOT (end of output,
+    # followed by the exception) if the MCU code failed, rather than the transfer
+    device.write(MCU_ABORT)
+    try:
+        # wait for the MCU to return to the raw REPL prompt, error message between EOTs
+        parts = (bytes(received) + device.read_until(EOT + b'>', timeout=1)).split(EOT)
+        if len(parts) > 2 and parts[-2].strip():
+            msg += f" ({parts[-2].decode(errors='replace').strip()})"
+    except TimeoutError:
+        pass
+    if received[0:1] in (BEL, EOT):
+        raise ReplException(msg)
+    raise XferError(msg)
+
+
 def _file_size(filepath):
     import os
     try:
@@ -0,0 +1,173 @@
+from .config_store import Config
+from .hash_cache import HashCache
+from .host_index import HostIndex
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import sys
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+"""
+Rsync projects to many devices in parallel:
+
+    from iot_device import DiscoverSerial, DiscoverNet, Fleet
+
+    fleet = Fleet([DiscoverSerial(), DiscoverNet()])
+    fleet.scan()
+    for r in fleet.rsync(dry_run=False):
+        print(r)
+
+Each device gets the projects configured for it in hosts.py (default ['base']).
+Host files are listed, hashed, read and encoded once and shared by all
+devices (HostIndex and HashCache of the fleet run, uploads see fcopy).
+"""
+
+
+class Fleet:
+
+    def __init__(self, discovers, max_workers=None):
+        self.__discovers = discovers
+        self.__max_workers = max_workers or Config.get('fleet_workers', 8)
+        self.__print_lock = threading.Lock()
+
+    def scan(self):
+        """Scan for devices with all discovers."""
+        for discover in self.__discovers:
+            discover.scan()
+
+    def devices(self, names=None):
+        """Discovered devices, optionally only those with uid or hostname in names.
+        Devices found by several discovers (e.g. serial and net) are returned once.
+        """
+        uids = { Config.hostname2uid(n) for n in names } if names else None
+        devices = {}
+        for discover in self.__discovers:
+            with discover as devs:
+                for dev in devs:
+                    if uids is None or dev.uid in uids:
+                        devices.setdefault(dev.uid, dev)
+        if uids:
+            for uid in uids - devices.keys():
+                logger.warning(f"{Config.uid2hostname(uid)} not found")
+        return list(devices.values())
+
+    def rsync(self, path='/', projects=None, dry_run=True, digests=None, names=None, output=None):
+        """Rsync all devices (or those in names), in parallel.
+        Returns list of results, one per device:
+            { 'uid', 'name', 'ok', 'time', 'error' }
+        """
+        output = output or StdOutput()
+        devices = self.devices(names)
+        host_index = HostIndex()
+        hash_cache = HashCache()
+        try:
+            with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="Fleet") as executor:
+                futures = [ executor.submit(self.__rsync, dev, path, projects, dry_run, digests, output,
+                                            host_index, hash_cache)
+                            for dev in devices ]
+                return [ f.result() for f in futures ]
+        finally:
+            host_index.save()
+            hash_cache.save()
+
+    def __rsync(self, device, path, projects, dry_run, digests, output, host_index, hash_cache):
+        name = Config.uid2hostname(device.uid)
+        dev_output = DeviceOutput(name, output, self.__print_lock)
+        start_time = time.monotonic()
+        res = { 'uid': device.uid, 'name': name, 'ok': True, 'error': None }
+        try:
+            with device as repl:
+                repl.rsync(dev_output, path, projects or Config.host_projects(device.uid), dry_run, digests,
+                           host_index, hash_cache)
+        except Exception as e:
+            logger.debug(f"rsync {name} failed: {e}")
+            res['ok'] = False
+            res['error'] = str(e)
+        dev_output.flush()
+        res['time'] = time.monotonic() - start_time
+        return res
+
+
+class DeviceOutput:
+    """Output of one device, lines prefixed with the device name."""
+
+    def __init__(self, name, output, lock):
+        self.__name = name
+        self.__output = output
+        self.__lock = lock
+        self.__partial = ''
+
+    def ans(self, s):
+        if isinstance(s, bytes):
+            s = s.decode(errors='replace')
+        lines = (self.__partial + s).split('\n')
+        self.__partial = lines.pop()
+        with self.__lock:
+            for line in lines:
+                # skip progress dots
+                if line.strip('.'):
+                    self.__output.ans(f"{self.__name:20} {line}\n")
+
+    def err(self, s):
+        if isinstance(s, bytes):
+            s = s.decode(errors='replace')
+        with self.__lock:
+            self.__output.err(f"{self.__name:20} {s}")
+
+    def flush(self):
+        if self.__partial:
+            self.ans('\n')
+
+
+class StdOutput:
+
+    def ans(self, s):
+        sys.stdout.write(s)
+
+    def err(self, s):
+        sys.stderr.write(s)
+
+
+##########################################################################
+# Main
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Rsync projects to all discovered devices in parallel.")
+    parser.add_argument('names', nargs='*', help="uids or hostnames (default: all devices found)")
+    parser.add_argument('--path', default='/', help="directory to sync (default: /)")
+    parser.add_argument('--projects', nargs='+', help="projects (default: from hosts.py)")
+    parser.add_argument('--serial', action='store_true', help="only devices on serial ports")
+    parser.add_argument('--net', action='store_true', help="only devices advertised on the network")
+    parser.add_argument('--workers', type=int, help="maximum number of devices synced in parallel")
+    parser.add_argument('--digests', action='store_true', help="compare file contents rather than times")
+    parser.add_argument('--dry-run', action='store_true', help="report changes without copying")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    from .discover_serial import DiscoverSerial
+    from .discover_net import DiscoverNet
+    discovers = []
+    if not args.net:
+        discovers.append(DiscoverSerial())
+    if not args.serial:
+        discovers.append(DiscoverNet())
+    fleet = Fleet(discovers, args.workers)
+    fleet.scan()
+    results = fleet.rsync(args.path, args.projects, args.dry_run, args.digests or None, args.names)
+
+    print(f"\n{'device':20} {'time':>8}  status")
+    for r in sorted(results, key=lambda r: r['name']):
+        status = 'ok' if r['ok'] else f"FAILED: {r['error']}"
+        print(f"{r['name']:20} {r['time']:7.1f}s  {status}")
+    failed = sum(not r['ok'] for r in results)
+    print(f"{len(results)-failed} of {len(results)} devices synced")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
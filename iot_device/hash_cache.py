@@ -0,0 +1,83 @@
+from .config_store import Config
+from .cache_file import atomic_json_save
+
+import hashlib
+import json
+import os
+import threading
+import zlib
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+"""
+Digests of host files, kept in `digests.json` in `cache_dir`.
+
+Entries are keyed by path and reused as long as the file's mtime and size
+are unchanged, so only files modified since the last run are hashed again:
+
+    cache = HashCache()
+    digest = cache.digest('/path/to/file', 'sha256')
+    cache.save()
+"""
+
+
+class HashCache:
+
+    def __init__(self, name='digests.json'):
+        self.__file = os.path.join(os.path.expanduser(Config.get('cache_dir')), name)
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        try:
+            with open(self.__file) as f:
+                self.__cache = json.load(f)
+        except (OSError, ValueError):
+            self.__cache = {}
+
+    def digest(self, path, algorithm):
+        """Digest of file at path, formatted like the MCU's ('sha256:...', 'crc32:...')."""
+        st = os.stat(path)
+        with self.__lock:
+            entry = self.__cache.get(path)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                digest = entry[2].get(algorithm)
+                if digest: return digest
+            else:
+                entry = [st.st_mtime_ns, st.st_size, {}]
+                self.__cache[path] = entry
+        digest = file_digest(path, algorithm)
+        with self.__lock:
+            entry[2][algorithm] = digest
+            self.__dirty = True
+        return digest
+
+    def save(self):
+        """Write cache to disk (if changed)."""
+        with self.__lock:
+            if not self.__dirty: return
+            try:
+                atomic_json_save(self.__file, self.__cache)
+                self.__dirty = False
+            except OSError as e:
+                logger.warning(f"Cannot save {self.__file}: {e}")
+
+
+def file_digest(path, algorithm):
+    """Compute digest of file at path ('sha256' or 'crc32')."""
+    if algorithm == 'sha256':
+        h = hashlib.sha256()
+        update = h.update
+    elif algorithm == 'crc32':
+        crc = 0
+        def update(b):
+            nonlocal crc
+            crc = zlib.crc32(b, crc)
+    else:
+        raise ValueError(f"Unknown digest algorithm {algorithm}")
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(65536), b''):
+            update(b)
+    if algorithm == 'sha256':
+        return 'sha256:' + h.hexdigest()
+    return 'crc32:{:08x}'.format(crc)
@@ -0,0 +1,129 @@
+from .config_store import Config
+from .cache_file import atomic_json_save
+
+import json
+import os
+import stat
+import threading
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+"""
+Index of host directory trees, saved as `host_index.json` in `cache_dir`.
+
+Directories are listed with os.scandir. A directory whose mtime is unchanged
+since the last run is not listed again. Files are still stat'ed since editing
+a file in place does not change the directory mtime, unless `host_index_stat_files`
+is set to False in config.py.
+
+Each tree is walked once per HostIndex, later calls of files() return the
+same result. Rsyncs of several devices (Fleet) share one index.
+
+    index = HostIndex()
+    files = index.files(root, path, project)
+    index.save()
+"""
+
+
+class HostIndex:
+
+    def __init__(self, name='host_index.json'):
+        self.__file = os.path.join(os.path.expanduser(Config.get('cache_dir')), name)
+        self.__stat_files = Config.get('host_index_stat_files', True)
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        self.__roots = set()
+        self.__visited = set()
+        # (root, path, project) -> result of files
+        self.__files = {}
+        try:
+            with open(self.__file) as f:
+                # absolute path of directory -> [mtime_ns, [subdirs], { file: [mtime, size] }]
+                self.__index = json.load(f)
+        except (OSError, ValueError):
+            self.__index = {}
+
+    def files(self, root, path, project):
+        """Dict of all files and directories in root/path.
+            name -> (project, mtime, size)
+           name is relative to root, size is -1 for directories.
+        """
+        key = (root, path, project)
+        with self.__lock:
+            files = self.__files.get(key)
+            if files is None:
+                files = self.__files[key] = self.__files_in(root, path, project)
+        return dict(files)
+
+    def save(self):
+        """Write index to disk (if changed), dropping directories that no longer exist."""
+        with self.__lock:
+            for d in list(self.__index.keys()):
+                if d in self.__visited: continue
+                if any(d.startswith(os.path.join(r, '')) for r in self.__roots):
+                    del self.__index[d]
+                    self.__dirty = True
+            if not self.__dirty: return
+            try:
+                atomic_json_save(self.__file, self.__index)
+                self.__dirty = False
+            except OSError as e:
+                logger.warning(f"Cannot save {self.__file}: {e}")
+
+    def __files_in(self, root, path, project):
+        files = {}
+        full_path = os.path.join(root, path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return files
+        if stat.S_ISDIR(st.st_mode):
+            self.__roots.add(full_path)
+            self.__walk(files, full_path, path, project, st)
+        elif stat.S_ISREG(st.st_mode):
+            files[path] = (project, st.st_mtime, st.st_size)
+        return files
+
+    def __walk(self, files, full_path, path, project, st):
+        files[path] = (project, st.st_mtime, -1)
+        self.__visited.add(full_path)
+        entry = self.__index.get(full_path)
+        if entry and entry[0] == st.st_mtime_ns:
+            # no files added or removed
+            _, subdirs, dir_files = entry
+            if self.__stat_files:
+                for name, v in dir_files.items():
+                    try:
+                        fst = os.stat(os.path.join(full_path, name))
+                    except OSError:
+                        continue
+                    if v != [fst.st_mtime, fst.st_size]:
+                        dir_files[name] = [fst.st_mtime, fst.st_size]
+                        self.__dirty = True
+        else:
+            subdirs = []
+            dir_files = {}
+            with os.scandir(full_path) as it:
+                for e in it:
+                    if e.name.startswith('.'): continue
+                    try:
+                        if e.is_dir():
+                            subdirs.append(e.name)
+                        elif e.is_file():
+                            fst = e.stat()
+                            dir_files[e.name] = [fst.st_mtime, fst.st_size]
+                    except OSError:
+                        continue
+            self.__index[full_path] = [st.st_mtime_ns, subdirs, dir_files]
+            self.__dirty = True
+        for name, (mtime, size) in dir_files.items():
+            files[os.path.join(path, name)] = (project, mtime, size)
+        for name in subdirs:
+            sub_path = os.path.join(full_path, name)
+            try:
+                sub_st = os.stat(sub_path)
+            except OSError:
+                continue
+            self.__walk(files, sub_path, os.path.join(path, name), project, sub_st)
@@ -0,0 +1,150 @@
+import ctypes
+import ctypes.util
+import selectors
+import socket
+import struct
+import errno
+import os
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+"""
+Serial port hotplug events (Linux).
+
+Kernel uevents (netlink) report tty devices as they are added and removed,
+inotify on /dev reports device nodes created, deleted or given new
+permissions (e.g. by udev rules), also in containers that do not get
+uevents. Either source is sufficient, Hotplug raises OSError if neither
+is available:
+
+    hp = Hotplug()
+    while True:
+        for action, port in hp.wait() or []:
+            print(action, port)   # 'add', 'remove', or 'rescan' (port None)
+"""
+
+NETLINK_KOBJECT_UEVENT = 15
+
+IN_ATTRIB      = 0x00000004
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = os.O_CLOEXEC
+
+# struct inotify_event (without name)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Hotplug:
+
+    def __init__(self, dev_dir='/dev'):
+        self.__dev_dir = dev_dir
+        self.__sel = selectors.DefaultSelector()
+        self.__files = []
+        for source in (self.__netlink, self.__inotify):
+            try:
+                f, handler = source()
+                self.__files.append(f)
+                self.__sel.register(f, selectors.EVENT_READ, handler)
+            except (OSError, AttributeError) as e:
+                logger.debug(f"Hotplug source {source.__name__} not available: {e}")
+        if not self.__files:
+            self.__sel.close()
+            raise OSError("no hotplug events (requires Linux netlink or inotify)")
+        # interrupt wait
+        self.__wake_r, self.__wake_w = socket.socketpair()
+        self.__wake_r.setblocking(False)
+        self.__sel.register(self.__wake_r, selectors.EVENT_READ, None)
+
+    def wait(self, timeout=None):
+        """List of (action, port) events, waiting for activity (the list may
+        be empty, e.g. for devices other than ttys).
+        Returns None when interrupted, empty list after timeout seconds.
+        """
+        events = []
+        for key, _ in self.__sel.select(timeout):
+            if key.data is None:
+                try:
+                    self.__wake_r.recv(64)
+                except BlockingIOError:
+                    pass
+                return None
+            events.extend(key.data(key.fileobj))
+        return events
+
+    def interrupt(self):
+        """Return from wait (called from another thread)."""
+        self.__wake_w.send(b'x')
+
+    def close(self):
+        self.__sel.close()
+        for f in self.__files:
+            if isinstance(f, int):
+                os.close(f)
+            else:
+                f.close()
+        self.__wake_r.close()
+        self.__wake_w.close()
+
+    def __netlink(self):
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            # port id assigned by kernel, multicast group 1: kernel events
+            s.bind((0, 1))
+            s.setblocking(False)
+        except OSError:
+            s.close()
+            raise
+        return s, self.__uevents
+
+    def __uevents(self, s):
+        events = []
+        while True:
+            try:
+                data = s.recv(8192)
+            except BlockingIOError:
+                return events
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # events were dropped
+                    events.append(('rescan', None))
+                    continue
+                raise
+            fields = dict(f.split('=', 1) for f in data.decode(errors='replace').split('\0') if '=' in f)
+            if fields.get('SUBSYSTEM') != 'tty' or not fields.get('DEVNAME'):
+                continue
+            action = fields.get('ACTION')
+            if action in ('add', 'remove'):
+                events.append((action, os.path.join(self.__dev_dir, fields['DEVNAME'])))
+
+    def __inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(fd, self.__dev_dir.encode(), IN_CREATE | IN_DELETE | IN_ATTRIB) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, f"cannot watch {self.__dev_dir}")
+        return fd, self.__inotify_events
+
+    def __inotify_events(self, fd):
+        events = []
+        while True:
+            try:
+                data = os.read(fd, 8192)
+            except BlockingIOError:
+                return events
+            i = 0
+            while i < len(data):
+                _, mask, _, size = INOTIFY_EVENT.unpack_from(data, i)
+                name = data[i+INOTIFY_EVENT.size:i+INOTIFY_EVENT.size+size].rstrip(b'\0').decode(errors='replace')
+                i += INOTIFY_EVENT.size + size
+                if mask & IN_Q_OVERFLOW:
+                    events.append(('rescan', None))
+                elif name.startswith('tty'):
+                    action = 'remove' if mask & IN_DELETE else 'add'
+                    events.append((action, os.path.join(self.__dev_dir, name)))
@@ -0,0 +1,113 @@
+from .config_store import Config
+from .cache_file import atomic_json_save
+
+import json
+import os
+import re
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+"""
+Last known listing of the files on a device, one file per uid in `cache_dir`/manifests.
+
+Listings are valid as long as the device's fingerprint is unchanged. The
+fingerprint combines a generation token, written to the device by the host
+after changing files, the number of free blocks of the MCU filesystem, and
+a checksum of the entries of its root directory.
+
+    manifest = Manifest(uid)
+    files = manifest.listing(path, digests, fingerprint)
+    if files is None:
+        files = ...   # list files on device
+        manifest.set_listing(path, digests, fingerprint, files)
+"""
+
+
+class Manifest:
+
+    def __init__(self, uid):
+        name = re.sub(r'[^\w.-]', '_', uid) + '.json'
+        self.__file = os.path.join(os.path.expanduser(Config.get('cache_dir')), 'manifests', name)
+        self.__fingerprint = None
+        # (path, digests) -> { name: (mtime, size, digest) }
+        self.__listings = {}
+        try:
+            with open(self.__file) as f:
+                m = json.load(f)
+            self.__fingerprint = m['fingerprint']
+            for l in m['listings']:
+                files = { k: tuple(v) for k, v in l['files'].items() }
+                self.__listings[(l['path'], l['digests'])] = files
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def listing(self, path, digests, fingerprint):
+        """Files in path or None if not known for this fingerprint."""
+        fingerprint = list(fingerprint)
+        if fingerprint != self.__fingerprint:
+            return None
+        files = self.__listings.get((path, digests))
+        if files is None and not digests:
+            # a listing with digests also has mtime and size
+            files = self.__listings.get((path, True))
+        return dict(files) if files is not None else None
+
+    def set_listing(self, path, digests, fingerprint, files):
+        fingerprint = list(fingerprint)
+        if fingerprint != self.__fingerprint:
+            self.__listings = {}
+            self.__fingerprint = fingerprint
+        self.__listings[(path, digests)] = dict(files)
+        self.save()
+
+    def add(self, name, mtime, size, digest=None):
+        """Record file (size >= 0) or directory (size -1) name added to the device.
+        digest(algorithm) returns the digest of the file's content.
+        """
+        for (path, digests), files in self.__listings.items():
+            if not self.__contains(path, name): continue
+            d = None
+            if digests and size >= 0 and digest:
+                algorithm = next((v[2].split(':')[0] for v in files.values() if v[2]), 'sha256')
+                d = digest(algorithm)
+            files[name] = (mtime, size, d)
+            # parent directories
+            parent = os.path.dirname(name)
+            while parent and self.__contains(path, parent) and not parent in files:
+                files[parent] = (mtime, -1, None)
+                parent = os.path.dirname(parent)
+
+    def remove(self, name):
+        """Record file or directory name (and its content) removed from the device."""
+        for files in self.__listings.values():
+            for k in list(files.keys()):
+                if k == name or k.startswith(name + '/'):
+                    del files[k]
+
+    def discard(self):
+        """Remove manifest from disk (device is being changed)."""
+        try:
+            os.remove(self.__file)
+        except OSError:
+            pass
+
+    def commit(self, fingerprint):
+        """Device changes are complete and listings updated."""
+        self.__fingerprint = list(fingerprint)
+        self.save()
+
+    def save(self):
+        try:
+            m = {
+                'fingerprint': self.__fingerprint,
+                'listings': [ { 'path': p, 'digests': d, 'files': f } for (p, d), f in self.__listings.items() ],
+            }
+            atomic_json_save(self.__file, m)
+        except OSError as e:
+            logger.warning(f"Cannot save {self.__file}: {e}")
+
+    def __contains(self, path, name):
+        # name is in listing of path?
+        return path == '' or name == path or name.startswith(path + '/')
@@ -2,85 +2,204 @@ from .device import Device
 from .repl import ReplException
 from .config_store import Config
 
+import select
 import socket
 import ssl
 import json
+import threading
 import time
 import logging
 
 logger = logging.getLogger(__file__)
 
+
+"""
+Device connected through a DeviceServer.
+
+With `net_pool = True` in config.py (or NetDevice(adv, pooled=True)),
+authenticated connections are kept when the `with` block exits and reused
+by the next one if they are idle for less than `net_pool_idle` seconds
+(default 30) and still open. New connections resume the previous TLS
+session with the server, skipping the certificate exchange.
+"""
+
+# idle connections: (uid, address) -> (socket, time returned to pool)
+_pool = {}
+_pool_lock = threading.Lock()
+
+# closes expired connections, runs while the pool is not empty
+_reaper = None
+
+# TLS sessions for resumption: address -> ssl.SSLSession
+_sessions = {}
+
+# sessions can only be resumed with the context that created them
+_context = None
+
+
 class PasswordError(Exception):
     pass
 
 class NetDevice(Device):
 
-    def __init__(self, adv):
+    def __init__(self, adv, pooled=None):
         self.__address = (adv['ip_addr'], adv['ip_port'])
         self.__socket = None
+        self.__pooled = Config.get('net_pool', False) if pooled is None else pooled
+        # receive buffer, reused for all reads
+        self.__buffer = memoryview(bytearray(Config.get('recv_buffer_size', 65536)))
         super().__init__(adv['uid'])
 
-    def read(self, size=1):
-        res = bytearray()
-        while len(res) < size:
-            b = self.__socket.recv(size-len(res))
-            if b:
-                res.extend(b)
-            else:
-                raise ConnectionResetError(f"Connection to {self.uid} closed")
-        return res
-
-    def read_all(self):
-        b = self.__socket.recv(1024)
-        if b: 
-            return b
+    def read_raw(self, size=1):
+        # view of the receive buffer, valid until the next read
+        n = self.__socket.recv_into(self.__buffer[:min(size, len(self.__buffer))])
+        if n:
+            return self.__buffer[:n]
         else:
             raise ConnectionResetError(f"Connection to {self.uid} closed")
 
+    def read_all_raw(self):
+        return bytes(self.read_raw(len(self.__buffer)))
+
     def write(self, data):
         self.__socket.sendall(data)
 
     def close(self):
-        self.__socket.close()
-        self.__socket = None
+        if self.__socket:
+            self.__socket.close()
+            self.__socket = None
         
     def __enter__(self):
         # acquire lock and create Repl (Rsync) object
         repl = super().__enter__()
-        self.__connect()
+        try:
+            if not self.__from_pool():
+                for attempt in range(3):
+                    try:
+                        self.__connect()
+                        break
+                    except PasswordError as e:
+                        # the server may not yet have closed a discarded pooled connection
+                        if not self.__pooled or e.args[0] != b'device busy' or attempt == 2:
+                            raise
+                        time.sleep(0.2)
+        except:
+            super().__exit__(None, None, None)
+            raise
         return repl
 
     def __exit__(self, typ, value, traceback):
-        self.close()
+        if self.__pooled and typ is None:
+            self.__to_pool()
+        else:
+            self.close()
         super().__exit__(typ, value, traceback)
 
+    def __from_pool(self):
+        # reuse idle connection, if available
+        if not self.__pooled:
+            return False
+        with _pool_lock:
+            entry = _pool.pop((self.uid, self.__address), None)
+        if not entry:
+            return False
+        sock, idle_since = entry
+        if time.monotonic() - idle_since > Config.get('net_pool_idle', 30) or not _idle_ok(sock):
+            logger.debug(f"net_device: discarding idle connection to {self.uid}")
+            sock.close()
+            return False
+        self.__socket = sock
+        return True
+
+    def __to_pool(self):
+        # keep connection for reuse
+        key = (self.uid, self.__address)
+        sock, self.__socket = self.__socket, None
+        global _reaper
+        with _pool_lock:
+            old = _pool.get(key)
+            _pool[key] = (sock, time.monotonic())
+            if not _reaper:
+                # close connections (and free the devices on the server) when unused
+                _reaper = threading.Thread(target=_reap, name='net_pool_reaper', daemon=True)
+                _reaper.start()
+        if old:
+            old[0].close()
+
     def __connect(self):
         # establish connection to server
         logger.debug("net_device.__connect")
         assert self.__socket == None
         self.__socket = socket.socket()
-        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1  # optional
-        # self signed certificate: disable verification
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        self.__socket = context.wrap_socket(self.__socket)
-        logger.debug("net_device.__connect  -- socket.connect")
-        self.__socket.connect(self.__address)
-        logger.debug("net_device.__connect  -- setsockopt")
-        self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # password check
-        logger.debug("net_device.__connect  -- send pwd")
-        msg = { 'uid': self.uid, 'password': Config.get('password') }
-        self.write(json.dumps(msg).encode())
-        logger.debug("net_device.__connect  -- wait for ok")
-        msg = self.read_all()
+        try:
+            self.__socket = _client_context().wrap_socket(self.__socket, session=_sessions.get(self.__address))
+            logger.debug("net_device.__connect  -- socket.connect")
+            self.__socket.connect(self.__address)
+            logger.debug("net_device.__connect  -- setsockopt")
+            self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # password check
+            logger.debug("net_device.__connect  -- send pwd")
+            msg = { 'uid': self.uid, 'password': Config.get('password') }
+            self.write(json.dumps(msg).encode() + b'\n')
+            logger.debug("net_device.__connect  -- wait for ok")
+            msg = self.read_all()
+        except:
+            # next attempt starts from scratch
+            self.close()
+            raise
         if msg != b'ok':
+            self.close()
             raise PasswordError(msg)
+        logger.debug(f"net_device.__connect  -- TLS session reused: {self.__socket.session_reused}")
+        # TLS 1.3 session tickets arrive after the handshake
+        _sessions[self.__address] = self.__socket.session
 
     def __hash__(self):
         return self.uid
 
     def __repr__(self):
-        return f"NetDevice {self.uid} at {self.__address}, age {self.age:.1}s"
\ No newline at end of file
+        return f"NetDevice {self.uid} at {self.__address}, age {self.age:.1}s"
+
+
+def _client_context():
+    global _context
+    if _context is None:
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1  # optional
+        # self signed certificate: disable verification
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        _context = context
+    return _context
+
+def _idle_ok(sock):
+    # no data is expected on an idle connection, readable means closed by the server
+    try:
+        if sock.pending():
+            return False
+        readable, _, _ = select.select([sock], [], [], 0)
+        return not readable
+    except (OSError, ValueError):
+        return False
+
+def _reap():
+    global _reaper
+    while True:
+        idle = Config.get('net_pool_idle', 30)
+        now = time.monotonic()
+        with _pool_lock:
+            expired = [ key for key, (_, idle_since) in _pool.items() if now - idle_since >= idle ]
+            expired = [ (key, _pool.pop(key)[0]) for key in expired ]
+            done = not _pool
+            if done:
+                _reaper = None
+            else:
+                # connections are added with later expiry times
+                wait = min(idle_since for _, idle_since in _pool.values()) + idle - now
+        for key, sock in expired:
+            logger.debug(f"net_device: closing idle connection to {key[0]}")
+            sock.close()
+        if done:
+            return
+        time.sleep(max(wait, 0.05))
@@ -1,5 +1,9 @@
+from .config_store import Config
+
 from contextlib import contextmanager
 from serial import SerialException
+import functools
+import hashlib
 import inspect
 import time
 import logging
@@ -24,6 +28,7 @@ MCU_RAW_REPL      = b'\x01'    # enter raw repl
 MCU_ABORT         = b'\x03'    # abort
 MCU_RESET         = b'\x04'    # reset
 MCU_EVAL          = b'\r\x04'  # start evaluation (raw repl)
+MCU_RAW_PASTE     = b'\x05A\x01' # enter raw-paste mode (raw repl)
 EOT               = b'\x04'
 
 # esp32 cannot handle more than 255 bytes per transfer
@@ -31,14 +36,31 @@ EOT               = b'\x04'
 # what's the performance penalty on nrf52?
 BUFFER_SIZE = 254 # 2048
 
+# Helper functions called with eval_func are installed in the globals of
+# the MCU's REPL and registered with their version in dict _iot49.
+# Code for calls to installed helpers starts with a version check.
+MCU_HELPERS_INIT  = 'try:\n    _iot49\nexcept NameError:\n    _iot49 = {}\n'
+MCU_HELPERS_ADD   = '_iot49[{name!r}] = {version!r}\n'
+MCU_HELPERS_CHECK = 'if _iot49.get({name!r}) != {version!r}: raise NameError("_iot49: {name} not installed")\n'
+
+
 class ReplException(Exception):
     pass
 
 
+def _helpers_missing(e):
+    # MCU_HELPERS_CHECK failed or _iot49 is gone
+    return 'NameError' in str(e) or '_iot49' in str(e)
+
+
 class Repl:
 
     def __init__(self, device):
         self.__device = device
+        # session: stay in raw repl between evals
+        self.__in_raw_repl = False
+        self.__prompt_pending = False
+        self.__handshake_time = 0.0
 
     @property
     def uid(self):
@@ -50,6 +72,11 @@ class Repl:
     def device(self):
         return self.__device
 
+    @property
+    def handshake_time(self) -> float:
+        """Time in seconds spent entering the raw REPL in the last eval."""
+        return self.__handshake_time
+
     def eval(self, code, output):
         """Eval code on remote (Micro)Python VM.
            Results are returned via the response call-back handler (class),
@@ -68,38 +95,70 @@ class Repl:
             logger.debug(f"Exception in eval {code}")
             raise ReplException(e)
 
-    def eval_func(self, func, *args, xfer_func=None, output=None, **kwargs):
-        """Call func(*args, **kwargs) on (Micro)Python board."""
+    def eval_func(self, func, *args, xfer_func=None, output=None, requires=(), **kwargs):
+        """Call func(*args, **kwargs) on (Micro)Python board.
+        func, and the MCU functions it calls (requires), are installed on the MCU
+        the first time they are used (see MCU_HELPERS), subsequent calls send just
+        the call expression. If they are gone (e.g. the MCU was reset), the call
+        fails with NameError (also when it aborts xfer_func, the MCU error is
+        part of the message) and is repeated once with the helpers reinstalled.
+        Other errors are not retried, the call may have had side effects.
+        """
         try:
             args_arr = [repr(i) for i in args]
             kwargs_arr = ["{}={}".format(k, repr(v)) for k, v in kwargs.items()]
-            func_str = inspect.getsource(func).replace('BUFFER_SIZE', str(BUFFER_SIZE))
-            func_str += 'import os\n'
-            func_str += 'os.chdir("/")\n'
-            func_str += 'output = ' + func.__name__ + '('
-            func_str += ', '.join(args_arr + kwargs_arr)
-            func_str += ')\n'
-            func_str += 'if output != None: print(output)\n'
-            # logger.debug(f"eval_func: {func_str}")
-            start_time = time.monotonic()
-            self.__exec_part_1(func_str)
-            if xfer_func:
-                xfer_func(self.device, *args, **kwargs)
-                logger.debug(f"returned from xfer_func")
-            output = self.__exec_part_2(output)
-            logger.debug("eval_func: {}({}) --> {},   in {:.3} s)".format(
+            installed = self.device.negotiated.setdefault('helpers', set())
+            for attempt in range(2):
+                helpers = []
+                func_str = ''
+                # helpers assumed to be installed
+                checked = False
+                for f in tuple(requires) + (func, ):
+                    source, version = _mcu_source(f)
+                    helpers.append((f.__name__, version))
+                    if (f.__name__, version) in installed:
+                        func_str += MCU_HELPERS_CHECK.format(name=f.__name__, version=version)
+                        checked = True
+                    else:
+                        func_str += MCU_HELPERS_INIT + source
+                        func_str += MCU_HELPERS_ADD.format(name=f.__name__, version=version)
+                func_str += 'import os\n'
+                func_str += 'os.chdir("/")\n'
+                func_str += 'output = ' + func.__name__ + '('
+                func_str += ', '.join(args_arr + kwargs_arr)
+                func_str += ')\n'
+                func_str += 'if output != None: print(output)\n'
+                # logger.debug(f"eval_func: {func_str}")
+                start_time = time.monotonic()
+                try:
+                    self.__exec_part_1(func_str)
+                    # installed when the code compiles
+                    installed.update(helpers)
+                    if xfer_func:
+                        xfer_func(self.device, *args, **kwargs)
+                        logger.debug(f"returned from xfer_func")
+                    result = self.__exec_part_2(output)
+                    break
+                except ReplException as e:
+                    if attempt or not checked or not _helpers_missing(e):
+                        raise
+                    # helpers lost, e.g. MCU was reset
+                    installed.clear()
+                    logger.debug(f"eval_func: reinstalling helpers for {func.__name__} ({e})")
+            logger.debug("eval_func: {}({}) --> {},   in {:.3} s (handshake {:.3} s))".format(
                 func.__name__,
                 repr(args)[1:-1],
-                output,
-                time.monotonic()-start_time))
-            if output:
+                result,
+                time.monotonic()-start_time,
+                self.handshake_time))
+            if result:
                 try:
-                    output = output.decode().strip()
+                    result = result.decode().strip()
                 except UnicodeDecodeError:
                     pass
             # successful evaluation implies device is online
             self.device.seen()   
-            return output
+            return result
         except SyntaxError as se:
             logger.error(f"Syntax {se}")
 
@@ -110,6 +169,9 @@ class Repl:
             self.device.write(MCU_RESET)
             self.device.write(b'\n')
             self.device.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+            self.__in_raw_repl = False
+            # reset clears helpers installed by eval_func
+            self.device.negotiated.pop('helpers', None)
             # successful evaluation implies device is online
             self.device.seen()   
             logger.debug("VM reset")
@@ -134,16 +196,74 @@ class Repl:
         if isinstance(code, str):
             code = code.encode()
         # logger.debug(f"EVAL {code.decode()}")
-        self.device.write(MCU_ABORT)
-        self.device.write(MCU_ABORT)
-        self.device.write(MCU_RAW_REPL)
-        self.device.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+        start_time = time.monotonic()
+        if not self.__resume_session():
+            self.device.write(MCU_ABORT)
+            self.device.write(MCU_ABORT)
+            self.device.write(MCU_RAW_REPL)
+            self.device.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+        self.__handshake_time = time.monotonic() - start_time
+        if self.__raw_paste(code):
+            return
         self.device.write(code)
         self.device.write(MCU_EVAL)
         # process result of format "OK _answer_ EOT _error_message_ EOT>"
         if self.device.read(2) != b'OK':
             raise ReplException(f"Cannot eval '{code}'")
 
+    def __raw_paste(self, code):
+        """Send code in raw-paste mode, with flow control by the device.
+        Returns False (nothing sent) if the firmware does not support it.
+        """
+        negotiated = self.device.negotiated
+        if negotiated.get('raw_paste') is False:
+            return False
+        self.device.write(MCU_RAW_PASTE)
+        ans = self.__read_exact(2)
+        if ans != b'R\x01':
+            if ans != b'R\x00':
+                # old firmware: ignores raw-paste request, re-enters raw repl
+                self.device.read_until(b'CTRL-B to exit\r\n>')
+            logger.debug("raw-paste mode not supported by firmware")
+            negotiated['raw_paste'] = False
+            return False
+        negotiated['raw_paste'] = True
+        window_size = int.from_bytes(self.__read_exact(2), 'little')
+        window_remaining = window_size
+        start = time.monotonic()
+        i = 0
+        while i < len(code):
+            while window_remaining == 0:
+                ans = self.__read_exact(1)
+                if ans == b'\x01':
+                    # device is ready for another window of data
+                    window_remaining += window_size
+                elif ans == EOT:
+                    # device aborted reception
+                    self.device.write(EOT)
+                    raise ReplException(f"Raw-paste aborted by device while sending '{code}'")
+                else:
+                    raise ReplException(f"Unexpected {ans} from device in raw-paste mode")
+            chunk = code[i:i+window_remaining]
+            self.device.write_direct(chunk)
+            window_remaining -= len(chunk)
+            i += len(chunk)
+        # end of data, device acknowledges with EOT and compiles
+        self.device.write(EOT)
+        self.device.read_until(EOT)
+        if len(code) > 2 * window_size:
+            self.device.drained(len(code), time.monotonic() - start)
+        return True
+
+    def __read_exact(self, size, timeout=5):
+        res = bytearray()
+        start = time.monotonic()
+        while len(res) < size:
+            if (time.monotonic() - start) > timeout:
+                raise TimeoutError(f"Timeout reading from IoT device, got '{res}', expected {size} bytes")
+            res.extend(self.device.read(size-len(res)))
+        return bytes(res)
+
     def __exec_part_2(self, output):
         if output:
             logger.debug(f"_exec_part_2 ...")
@@ -153,6 +273,7 @@ class Repl:
                 if len(ans) > 1:      # 1st EOT
                     if len(ans[1]): output.err(ans[1])
                     if len(ans) > 2:  # 2nd EOT
+                        self.__end_session(ans[2])
                         return
                     break             # look for 2nd EOT below
             # read error message, if any
@@ -160,6 +281,7 @@ class Repl:
                 ans = self.device.read_all().split(EOT)
                 if len(ans[0]): output.err(ans[0])
                 if len(ans) > 1:      # 2nd EOT
+                    self.__end_session(ans[1])
                     break
         else:
             result = bytearray()
@@ -169,12 +291,40 @@ class Repl:
                     break
             s = result.split(EOT)
             logger.debug(f"repl s={s}")
+            self.__end_session(s[2])
             if len(s[1]) > 0:
                 # s[1] is exception
                 logger.debug(f"_exec_part_2 s={s} s[1]={s[1]}")
                 raise ReplException(s[1].decode())
             return s[0]
 
+    def __end_session(self, tail):
+        # eval completed and MCU is back at the raw REPL prompt (tail ends with '>')
+        self.__in_raw_repl = Config.get('repl_session', True)
+        self.__prompt_pending = not tail.endswith(b'>')
+
+    def __resume_session(self):
+        """True if the MCU is in the raw REPL, waiting for code, from the previous eval.
+        Any error or timeout ends the session (next eval does a full handshake).
+        """
+        if not self.__in_raw_repl:
+            return False
+        self.__in_raw_repl = False
+        if self.__prompt_pending:
+            try:
+                self.device.read_until(b'>', timeout=0.5)
+            except TimeoutError:
+                logger.debug("lost raw REPL session, re-synchronizing")
+                return False
+        return True
+
+@functools.lru_cache(maxsize=None)
+def _mcu_source(func):
+    """Source code of func for the MCU and its version."""
+    source = inspect.getsource(func).replace('BUFFER_SIZE', str(BUFFER_SIZE))
+    return source, hashlib.sha1(source.encode()).hexdigest()[:8]
+
+
 ##########################################################################
 # Code running on MCU
 
@@ -231,8 +381,20 @@ def _device_characteristics():
     except ImportError:
         has_binascii = False
 
+    # module for decompressing raw deflate streams
+    decompress = None
+    for name in ('zlib', 'uzlib', 'deflate'):
+        try:
+            m = __import__(name)
+            if hasattr(m, 'decompress') or hasattr(m, 'DeflateIO'):
+                decompress = name
+                break
+        except ImportError:
+            pass
+
     #     year  m  d  H  M  S   W  dy
     st = (2000, 1, 1, 0, 0, 0, -1, -1, -1)
     epoch = 946684800-time.mktime(st)
 
-    return { 'has_buffer': has_buffer, 'has_binascii': has_binascii, 'time_offset': epoch }
+    return { 'has_buffer': has_buffer, 'has_binascii': has_binascii, 'decompress': decompress,
+             'platform': sys.platform, 'time_offset': epoch }
@@ -1,9 +1,14 @@
 from .fcopy import Fcopy
 from .config_store import Config
+from .hash_cache import HashCache
+from .host_index import HostIndex
+from .manifest import Manifest
 from termcolor import colored    # pylint: disable=import-error
 
 from datetime import datetime
+import binascii
 import os
+import time
 import logging
 
 logger = logging.getLogger(__file__)
@@ -13,6 +18,22 @@ logger = logging.getLogger(__file__)
 Device with added features:
 * get/put files
 * rlist, rdiff, rsync
+
+rdiff compares files by size and modification time or, with digests=True,
+by content: the MCU reports a sha256 (or crc32) digest per file and the
+host compares it to the digest of its copy (cached in HashCache).
+
+Listings of the MCU are kept in a Manifest per device and reused while the
+device fingerprint (see _mcu_fingerprint) is unchanged. fput and rm_rf
+update the manifest, the new fingerprint is set at the end of rsync and
+fput_batch, after single uploads before the next listing. The fingerprint may miss changes
+made by others (e.g. a same-size edit in a subdirectory), rdiff with
+digests=True therefore always lists the MCU.
+
+rsync sends changes with fput_batch (a single eval) when there are at least
+`rsync_batch_min` (default 4) of them. Large files are updated with fpatch.
+The HostIndex and HashCache of an rsync can be shared with rsyncs of other
+devices (see Fleet), so the host files are listed and hashed only once.
 """
 
 
@@ -20,14 +41,25 @@ class Rsync(Fcopy):
 
     def __init__(self, connection):
         super().__init__(connection)
+        self.__manifest = None
+        self.__batch = False
+        self.__changed = False
+        self.__stale = False
+        # during rsync
+        self.__host_index = None
+        self.__hash_cache = None
 
     def rlist(self, output, path='/'):
         logger.debug(f"rlist {path}")
         self.__mcu_list(ListOutput(output), path)
 
-    def rdiff(self, output, path='/', projects=['base']):
-        mcu_files = self.mcu_files(output, path)
+    def rdiff(self, output, path='/', projects=['base'], digests=None):
+        if digests is None:
+            digests = Config.get('rsync_digests', False)
+        mcu_files = self.mcu_files(output, path, digests)
         host_files = self.host_files(path, projects)
+        hash_cache = (self.__hash_cache or HashCache()) if digests else None
+        host_dir = os.path.expanduser(Config.get('host_dir'))
         # add files from host
         to_add = host_files.keys() - mcu_files.keys()
         # delete files not on host
@@ -35,11 +67,20 @@ class Rsync(Fcopy):
         # in both: may need updating
         to_update = set()
         for u in mcu_files.keys() & host_files.keys():
-            mcu_time, mcu_size = mcu_files[u]
-            _, host_time, host_size = host_files[u]
+            mcu_time, mcu_size, mcu_digest = mcu_files[u]
+            project, host_time, host_size = host_files[u]
             # size < 1 indicates directory
-            if (mcu_size != host_size) or ((mcu_time < host_time) and mcu_size >= 0):
+            if mcu_size != host_size:
+                to_update.add(u)
+            elif digests and mcu_digest and mcu_size >= 0:
+                algorithm = mcu_digest.split(':')[0]
+                host_digest = hash_cache.digest(os.path.join(host_dir, project, u), algorithm)
+                if mcu_digest != host_digest:
+                    to_update.add(u)
+            elif (mcu_time < host_time) and mcu_size >= 0:
                 to_update.add(u)
+        if hash_cache and hash_cache is not self.__hash_cache:
+            hash_cache.save()
         # convert to_add and to_update to dicts pointing to project
         return (
             { k: host_files[k][0] for k in to_add },
@@ -47,81 +88,239 @@ class Rsync(Fcopy):
             { k: host_files[k][0] for k in to_update }
         )
 
-    def rsync(self, output, path='/', projects=['base'], dry_run=True):
+    def rsync(self, output, path='/', projects=['base'], dry_run=True, digests=None, host_index=None, hash_cache=None):
+        """Update files in path on the MCU to match the projects on the host.
+        host_index, hash_cache: shared with other rsyncs, saved by the caller.
+        """
+        self.__host_index = host_index or HostIndex()
+        self.__hash_cache = hash_cache or HashCache()
+        try:
+            self.__rsync(output, path, projects, dry_run, digests)
+        finally:
+            if host_index is None:
+                self.__host_index.save()
+            if hash_cache is None:
+                self.__hash_cache.save()
+            self.__host_index = self.__hash_cache = None
+
+    def __rsync(self, output, path, projects, dry_run, digests):
         logger.debug(f"rsync {path} projects={projects}")
         if not dry_run:
             # sync mcu time to host if they differ by more than 3 seconds
             self.sync_time(3)
-        add_, del_, upd_ = self.rdiff(output, path, projects)
+        add_, del_, upd_ = self.rdiff(output, path, projects, digests)
         if add_ or del_ or upd_:
-            for a,p in add_.items():
-                # do not report redundant directory creation
-                src_file = os.path.expanduser(os.path.join(Config.get('host_dir'), p, a))
-                if os.path.isfile(src_file):
-                    output.ans(colored(f"COPY    {a}\n", 'green'))
-                if not dry_run:
-                    self.fput(p, a)
-            for d in del_:
-                output.ans(colored(f"DELETE  {d}\n", 'red'))
-                if not dry_run:
-                    self.rm_rf(d, recursive=True)
-            for u,p in upd_.items():
-                output.ans(colored(f"UPDATE  {u}\n", 'blue'))
-                if not dry_run:
-                    self.fput(p, u)
+            # update fingerprint once, when done
+            self.__batch = True
+            try:
+                self.__sync(output, add_, del_, upd_, dry_run)
+            finally:
+                self.__batch = False
+            self.__commit()
         else:
             output.ans("Directories match\n")
 
-    def mcu_files(self, output, path):
+    def __sync(self, output, add_, del_, upd_, dry_run):
+        batch_min = Config.get('rsync_batch_min', 4)
+        if not dry_run and batch_min and len(add_) + len(del_) + len(upd_) >= batch_min:
+            self.__sync_batch(output, add_, del_, upd_)
+            return
+        for a,p in add_.items():
+            # do not report redundant directory creation
+            src_file = os.path.expanduser(os.path.join(Config.get('host_dir'), p, a))
+            if os.path.isfile(src_file):
+                output.ans(colored(f"COPY    {a}\n", 'green'))
+            if not dry_run:
+                self.fput(os.path.join(p, a), a)
+        for d in del_:
+            output.ans(colored(f"DELETE  {d}\n", 'red'))
+            if not dry_run:
+                self.rm_rf(d, recursive=True)
+        for u,p in upd_.items():
+            output.ans(colored(f"UPDATE  {u}\n", 'blue'))
+            if not dry_run:
+                self.fpatch(os.path.join(p, u), u)
+
+    def __sync_batch(self, output, add_, del_, upd_):
+        # all changes in one eval (fput_batch)
+        files = []
+        patches = []
+        for a,p in add_.items():
+            # directories are created for the files they contain
+            src_file = os.path.expanduser(os.path.join(Config.get('host_dir'), p, a))
+            if os.path.isfile(src_file):
+                output.ans(colored(f"COPY    {a}\n", 'green'))
+                files.append((os.path.join(p, a), a))
+        for d in del_:
+            output.ans(colored(f"DELETE  {d}\n", 'red'))
+        delta_min = self.delta_min
+        for u,p in upd_.items():
+            output.ans(colored(f"UPDATE  {u}\n", 'blue'))
+            src_file = os.path.expanduser(os.path.join(Config.get('host_dir'), p, u))
+            if delta_min and os.path.isfile(src_file) and os.path.getsize(src_file) >= delta_min:
+                # large files: send changes only
+                patches.append((os.path.join(p, u), u))
+            else:
+                files.append((os.path.join(p, u), u))
+        res = self.fput_batch(files, deletes=del_)
+        for local_file, remote_file in patches:
+            res[remote_file] = self.fpatch(local_file, remote_file)
+        for path, ok in res.items():
+            if not ok:
+                output.ans(colored(f"FAILED  {path}\n", 'red'))
+
+    def mcu_files(self, output, path, digests=False):
         """Dict of all files and directories on MCU.
-            name -> ()
+            name -> (mtime, size, digest)
+           size is -1 for directories, digest None unless requested and supported by the MCU.
         """
         if path.endswith('/'):    path = path[:-1]
         if path.startswith('/'):  path = path[1:]
+        # pending changes, e.g. from fput
+        fingerprint = self.__commit()
+        manifest = self.__get_manifest()
+        if manifest and not fingerprint:
+            fingerprint = self.fingerprint()
+        if manifest and not digests:
+            # content comparison: do not trust the fingerprint
+            files = manifest.listing(path, digests, fingerprint)
+            if files is not None:
+                logger.debug(f"mcu_files: {self.device.uid} unchanged, using manifest")
+                return files
         path_output = PathOutput(output)
-        self.__mcu_list(path_output, path)
+        self.__mcu_list(path_output, path, digests)
         output.ans('\n')
+        if manifest:
+            manifest.set_listing(path, digests, fingerprint, path_output.files)
         return path_output.files
 
+    def fingerprint(self, update=False):
+        """Fingerprint of files on the MCU. Update sets a new generation token."""
+        token = binascii.hexlify(os.urandom(6)).decode() if update else None
+        return eval(self.eval_func(_mcu_fingerprint, token))
+
+    def fput(self, local_file, remote_file):
+        res = super().fput(local_file, remote_file)
+        manifest = self.__get_manifest()
+        if manifest and res is not False:
+            # committed with the next listing
+            self.__change(manifest)
+            self.__added(manifest, local_file, remote_file)
+        return res
+
+    def fpatch(self, local_file, remote_file):
+        manifest = self.__get_manifest()
+        if manifest:
+            self.__change(manifest)
+        res = super().fpatch(local_file, remote_file)
+        if manifest:
+            if res is not False:
+                self.__added(manifest, local_file, remote_file)
+            else:
+                self.__stale = True
+        return res
+
+    def fput_batch(self, files=(), makedirs=(), deletes=()):
+        manifest = self.__get_manifest()
+        if manifest:
+            self.__change(manifest)
+        res = super().fput_batch(files, makedirs, deletes)
+        if manifest:
+            for path in deletes:
+                if res.get(path):
+                    manifest.remove(path.strip('/'))
+                else:
+                    self.__stale = True
+            for path in makedirs:
+                if res.get(path):
+                    manifest.add(path.strip('/'), time.time(), -1)
+            for local_file, remote_file in files:
+                if res.get(remote_file):
+                    self.__added(manifest, local_file, remote_file)
+                elif remote_file in res:
+                    # partially written?
+                    self.__stale = True
+            self.__commit()
+        return res
+
+    def rm_rf(self, path, recursive=False):
+        manifest = self.__get_manifest()
+        if manifest:
+            self.__change(manifest)
+        res = super().rm_rf(path, recursive)
+        if manifest:
+            if res == 'True':
+                manifest.remove(path.strip('/'))
+            else:
+                # partially removed?
+                self.__stale = True
+        return res
+
     def host_files(self, path, projects=['base']):
-        """Dict of all files and directories on MCU.
-            name -> ()
+        """Dict of all files and directories on host.
+            name -> (project, mtime, size)
         """
         if path.endswith('/'):    path = path[:-1]
         if path.startswith('/'):  path = path[1:]
         files = dict()
+        index = self.__host_index or HostIndex()
         for proj in projects:
             full_path = os.path.join(Config.get('host_dir'), proj)
             full_path = os.path.expanduser(full_path)
-            self.__host_list(files, full_path, proj, path)
+            files.update(index.files(full_path, path, proj))
+        if index is not self.__host_index:
+            index.save()
         return files
 
-    def __mcu_list(self, output, path):
+    def __get_manifest(self):
+        if self.__manifest is None and self.device.uid and Config.get('rsync_manifest', True):
+            self.__manifest = Manifest(self.device.uid)
+        return self.__manifest
+
+    def __added(self, manifest, local_file, remote_file):
+        src_file_name = os.path.join(os.path.expanduser(Config.get('host_dir')), local_file)
+        st = os.stat(src_file_name)
+        def digest(algorithm):
+            # only for listings with digests
+            # cache of this rsync, saved when it is done
+            hash_cache = self.__hash_cache or HashCache()
+            res = hash_cache.digest(src_file_name, algorithm)
+            if hash_cache is not self.__hash_cache:
+                hash_cache.save()
+            return res
+        manifest.add(remote_file.strip('/'), st.st_mtime, st.st_size, digest)
+
+    def __change(self, manifest):
+        # MCU files about to change, invalidate manifest on disk until committed
+        if not self.__changed:
+            manifest.discard()
+            self.__changed = True
+
+    def __commit(self):
+        # changes complete, save manifest with new fingerprint
+        # returns the fingerprint, None if nothing was committed
+        if not self.__changed or self.__batch:
+            return None
+        self.__changed = False
+        if self.__stale:
+            # manifest stays discarded, next listing walks the MCU
+            self.__manifest = None
+            self.__stale = False
+            return None
+        fingerprint = self.fingerprint(update=True)
+        self.__manifest.commit(fingerprint)
+        return fingerprint
+
+    def __mcu_list(self, output, path, digests=False):
         """Request MCU to list files and process resuls via output objects"""
         # drop trailing and leading / from path
-        self.eval_func(_mcu_list, path, 0, output=output)
-
-    def __host_list(self, files, root, project, path, level=0):
-        # add all files in root root/path to files dict
-        full_path = os.path.join(root, path)
-        if not os.path.exists(full_path): return
-        mtime = os.path.getmtime(full_path)
-        if os.path.isdir(full_path):
-            # directory
-            files[path] = (project, mtime, -1)
-            for p in os.listdir(full_path):
-                if p.startswith('.'): continue
-                self.__host_list(files, root, project, os.path.join(path, p), level+1)
-        elif os.path.isfile(full_path):
-            size = os.path.getsize(full_path)
-            # file
-            files[path] = (project, mtime, size)
+        self.eval_func(_mcu_list, path, 0, digests, output=output)
 
 
 #########################################################################
 # code running on MCU
 
-def _mcu_list(path, level):
+def _mcu_list(path, level, digests=False):
     import os
     t_off = 0
     try:
@@ -130,6 +329,30 @@ def _mcu_list(path, level):
         machine
     except ImportError:
         pass
+    def digest(path):
+        # sha256 or crc32 of file at path, '' if neither is available
+        crc = 0
+        try:
+            import hashlib
+            h = hashlib.sha256()
+        except (ImportError, AttributeError):
+            h = None
+            try:
+                from binascii import crc32
+            except ImportError:
+                return ''
+        buf = bytearray(512)
+        with open(path, 'rb') as f:
+            while True:
+                n = f.readinto(buf)
+                if not n: break
+                if h:
+                    h.update(memoryview(buf)[0:n])
+                else:
+                    crc = crc32(memoryview(buf)[0:n], crc)
+        if h:
+            return 'sha256:' + ''.join('{:02x}'.format(b) for b in h.digest())
+        return 'crc32:{:08x}'.format(crc & 0xffffffff)
     try:
         stat = os.stat(path)
         fsize = stat[6]
@@ -138,80 +361,122 @@ def _mcu_list(path, level):
             print(" D,{},{},{},0".format(level, repr(path), mtime))
             os.chdir(path)
             for p in os.listdir():
-                _mcu_list(p, level+1)
+                _mcu_list(p, level+1, digests)
             try:
                 # esp32 throws error when in /flash
                 os.chdir('..')
             except:
                 pass
         else:
-            print(" F,{},{},{},{}".format(level, repr(path), mtime, fsize))
+            print(" F,{},{},{},{}{}".format(level, repr(path), mtime, fsize,
+                  ',' + digest(path) if digests else ''))
     except:
         pass
 
 
+def _mcu_fingerprint(token=None):
+    # generation token (written by host after changing files), free blocks,
+    # and a checksum of the names, sizes and mtimes in the root directory
+    import os
+    if token:
+        try:
+            with open('.iot49_gen', 'w') as f:
+                f.write(token)
+        except OSError:
+            pass
+    try:
+        with open('.iot49_gen') as f:
+            gen = f.read()
+    except OSError:
+        gen = ''
+    try:
+        free = os.statvfs('')[3]
+    except:
+        free = -1
+    root = 0
+    try:
+        for name in os.listdir():
+            st = os.stat(name)
+            for v in [ ord(c) for c in name ] + [ st[6], st[8] ]:
+                root = (root * 31 + v) & 0xffffffff
+    except:
+        root = -1
+    return repr((gen, free, root))
+
+
 #########################################################################
 # Collect output from _mcu_list
 
-class ListOutput:
+class LineOutput:
+    """Pass complete lines of output to method line (data arrives in chunks)."""
 
     def __init__(self, output):
         self.output = output
+        self.__partial = b''
+
+    def ans(self, b):
+        lines = (self.__partial + b).split(b'\n')
+        self.__partial = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                self.line(line)
+
+    def err(self, b):
+        self.output.err(b)
+
+
+class ListOutput(LineOutput):
+
+    def __init__(self, output):
+        super().__init__(output)
         self._level_offset = 0
 
     def indent(self, level):
         return ' '*4*(level + self._level_offset)
 
-    def ans(self, b):
-        line = b.strip()
-        if line:
-            kind, level, path, mtime, size = line.split(b',')
-            path = eval(path)
-            level = int(level)
-            ts = datetime.fromtimestamp(int(mtime))
-            mtime = ts.strftime("%b %d %H:%M %Y")
-            if kind == b'D':
-                if level != 0:
-                    path = path if path.endswith('/') else path+'/'
-                    self.output.ans(f"{' '*7}  {mtime}  {self.indent(level)}{colored(path, 'green')}\n")
-                else:
-                    self._level_offset = -1
+    def line(self, line):
+        kind, level, path, mtime, size = line.split(b',')
+        path = eval(path)
+        level = int(level)
+        ts = datetime.fromtimestamp(int(mtime))
+        mtime = ts.strftime("%b %d %H:%M %Y")
+        if kind == b'D':
+            if level != 0:
+                path = path if path.endswith('/') else path+'/'
+                self.output.ans(f"{' '*7}  {mtime}  {self.indent(level)}{colored(path, 'green')}\n")
             else:
-                self.output.ans(f"{int(size):7}  {mtime}  {self.indent(level)}{colored(path, 'blue')}\n")
-
-    def err(self, b):
-        self.output.err(b)
+                self._level_offset = -1
+        else:
+            self.output.ans(f"{int(size):7}  {mtime}  {self.indent(level)}{colored(path, 'blue')}\n")
 
 
-class PathOutput:
+class PathOutput(LineOutput):
 
     def __init__(self, output):
+        super().__init__(output)
         self.path_stack = []
         self.files = {}
-        self.output = output
 
-    def ans(self, b):
-        line = b.strip()
-        if line:
-            kind, level, path, mtime, size = line.split(b',')
-            path  = eval(path)
-            # ignore files and directories with names that start with a period
-            # these files, when created on the mcu, won't be deleted by rsync
-            if path.startswith('.'):
-                return
-            level = int(level)
-            mtime = int(mtime)
-            size  = int(size)
-            full_path = os.path.join(*self.path_stack[:level], path)
-            if kind == 'D':
-                self.files[full_path] = (mtime, -1)
-                while len(self.path_stack) < level+1:
-                    self.path_stack.append('')
-                self.path_stack[level] = path
-            else:
-                self.files[full_path] = (mtime, size)
-                if len(self.files) % 10 == 0:
-                    self.output.ans('.')
-
-    def err(self, b):
-        self.output.err(b)
+    def line(self, line):
+        kind, level, path, mtime, size, *digest = line.split(b',')
+        path  = eval(path)
+        level = int(level)
+        mtime = int(mtime)
+        size  = int(size)
+        full_path = os.path.join(*self.path_stack[:level], path)
+        if kind == b'D':
+            while len(self.path_stack) < level+1:
+                self.path_stack.append('')
+            self.path_stack[level] = path
+        # ignore files and directories with names that start with a period
+        # these files, when created on the mcu, won't be deleted by rsync
+        if any(p.startswith('.') for p in full_path.split('/')):
+            return
+        if kind == b'D':
+            self.files[full_path] = (mtime, -1, None)
+        else:
+            digest = digest[0].decode() if digest and digest[0] else None
+            self.files[full_path] = (mtime, size, digest)
+            if len(self.files) % 10 == 0:
+                self.output.ans('.')
@@ -1,4 +1,7 @@
 from .device import Device
+from .repl import ReplException
+from .config_store import Config
+from .device_settings import device_settings
 
 from serial import Serial, SerialException
 import time
@@ -6,30 +9,99 @@ import logging
 
 logger = logging.getLogger(__file__)
 
+
+"""
+Device on a serial port.
+
+Writes to boards behind USB to UART bridges are paced: at most WRITE_CHUNK
+bytes are queued in the adapter, and data is not sent faster than
+PACING_HEADROOM times the rate at which the device consumed it before
+(learned from transfers with acks, remembered per uid, or set with
+`serial_drain_rate` in bytes/s). Native USB devices (USB-CDC) and ports
+with hardware flow control (`serial_rtscts`) are not paced.
+
+negotiate_baudrate switches boards behind UART bridges to the highest
+baudrate in `serial_baudrates` that passes an echo test (or to `baudrate`,
+if set in hosts.py). The MCU returns to the previous rate by itself unless
+the host confirms the new one. Trying a rate that fails takes several
+seconds, so DiscoverSerial negotiates after probing a port, or after a
+device was found at the default rate (e.g. it was reset), rather than when
+a client opens the device. The rate is remembered per uid and tried first
+when the device is opened again, e.g. after a gateway restart.
+
+The MCU switches the REPL UART, the first in `serial_repl_uarts` (default
+[0]) that runs at the current rate, with the first timer in
+`serial_baudrate_timers` that exists (default [-1, 3], virtual timer if
+available). Ports that have neither, or do not allow re-initializing the
+UART, stay at the default rate.
+"""
+
+# bytes per write to the serial port
+WRITE_CHUNK = 256
+
+# pace writes at this multiple of the learned drain rate
+PACING_HEADROOM = 1.5
+
+# MCU reverts to the previous baudrate unless the new one is confirmed within
+BAUDRATE_REVERT_MS = 2000
+
+# sent to the MCU and back to check a new baudrate
+ECHO_PATTERN = ''.join(chr(c) for c in range(33, 127)) * 8
+
+
 class SerialDevice(Device):
 
-    def __init__(self, port, description, baudrate=115200):
+    def __init__(self, port, description, baudrate=115200, uid=None, mismatch=None, native_usb=False):
+        """uid: known (e.g. cached) uid of the device, checked on first use.
+        If the device reports a different uid, mismatch(device, uid) is called
+        and __enter__ raises ReplException.
+        native_usb: device has flow control (e.g. USB-CDC rather than a UART bridge).
+        """
         self.__port = port
         self.__description = description
+        self.__default_baudrate = baudrate
+        if uid and not native_usb:
+            # MCU may still be at the rate negotiated before
+            baudrate = device_settings().get(uid, 'baudrate') or baudrate
         self.__baudrate = baudrate
-        self.__connect()
-        super().__init__()
+        # baudrate negotiated (or not needed)
+        self.__baudrate_checked = True
+        self.__serial = None
+        self.__verify = uid is not None
+        self.__mismatch = mismatch
+        self.__native_usb = native_usb
+        self.__rtscts = False
+        self.__drain_rate = None
+        self.__next_write = 0
+        # learn drain rate once uid is known
+        self.__learn = False
+        if not uid:
+            # port is opened on first use if uid is known
+            self.__connect()
+        super().__init__(uid)
+        self.__rtscts = Config.host_setting(self.uid, 'serial_rtscts', False)
+        self.__fixed_rate = Config.host_setting(self.uid, 'serial_drain_rate', None)
+        self.__drain_rate = self.__fixed_rate or device_settings().get(self.uid, 'drain_rate')
+        self.__learn = not self.__fixed_rate
+        # probed devices: negotiate right away, others once they are used at the default rate
+        self.__baudrate_checked = native_usb or uid is not None
 
     def __connect(self):
         try:
-            self.__serial = Serial(self.__port, self.__baudrate, parity='N', timeout=0.5)
+            self.__serial = Serial(self.__port, self.__baudrate, parity='N', timeout=0.5, rtscts=self.__rtscts)
         except SerialException as se:
             logger.info(f"SerialDevice: __connect failed {se}")
 
-    def read(self, size=1):
+    def read_raw(self, size=1):
         for _ in range(2):
             try:
-                return self.__serial.read(size)
+                # whatever is available, wait (timeout) for at least one byte
+                return self.__serial.read(max(1, min(size, self.__serial.in_waiting)))
             except (SerialException, OSError):
                 self.__connect()
         raise SerialException("read failed")
 
-    def read_all(self):
+    def read_all_raw(self):
         for _ in range(2):
             try:
                 return self.__serial.read_all()
@@ -40,23 +112,177 @@ class SerialDevice(Device):
     def write(self, data):
         for _ in range(2):
             try:
-                n = 0
-                for i in range(0, len(data), 256):
-                    n += self.__serial.write(data[i:min(i+256, len(data))])
-                    time.sleep(0.01)
-                return n
+                if self.__native_usb or self.__rtscts:
+                    return self.__serial.write(data)
+                return self.__paced_write(data)
             except (SerialException, OSError):
                 self.__connect()
         raise SerialException("write failed")
 
+    def __paced_write(self, data):
+        serial = self.__serial
+        rate = self.__drain_rate and PACING_HEADROOM * self.__drain_rate
+        # time to send a chunk at the baudrate (10 bits per byte)
+        chunk_time = WRITE_CHUNK * 10 / self.__baudrate
+        n = 0
+        for i in range(0, len(data), WRITE_CHUNK):
+            chunk = data[i:i+WRITE_CHUNK]
+            while serial.out_waiting > WRITE_CHUNK:
+                time.sleep(chunk_time / 4)
+            if rate:
+                now = time.monotonic()
+                if self.__next_write > now:
+                    time.sleep(self.__next_write - now)
+                    now = self.__next_write
+                self.__next_write = max(now, self.__next_write) + len(chunk) / rate
+            n += serial.write(chunk)
+        return n
+
+    def write_direct(self, data):
+        for _ in range(2):
+            try:
+                return self.__serial.write(data)
+            except (SerialException, OSError):
+                self.__connect()
+        raise SerialException("write failed")
+
+    def drained(self, size, seconds):
+        if not self.__learn or seconds <= 0: return
+        sample = size / seconds
+        rate = self.__drain_rate
+        self.__drain_rate = sample if rate is None else 0.7 * rate + 0.3 * sample
+        if rate is None or abs(self.__drain_rate - rate) > 0.2 * rate:
+            settings = device_settings()
+            settings.put(self.uid, 'drain_rate', round(self.__drain_rate))
+            settings.save()
+
     def close(self):
-        self.__serial.close()
+        if self.__serial:
+            self.__serial.close()
+
+    def fileno(self):
+        try:
+            return self.__serial.fileno()
+        except (AttributeError, SerialException, OSError):
+            # e.g. not available on Windows
+            return None
 
     def __enter__(self):
         res = super().__enter__()
         self.__connect()
+        try:
+            if self.__verify:
+                uid = self.__find_uid(res)
+                if uid != self.uid:
+                    if self.__mismatch:
+                        self.__mismatch(self, uid)
+                    # removed from discovery, free the port for probing
+                    self.close()
+                    raise ReplException(f"Device at {self.__port} has uid {uid}, expected {self.uid}")
+                self.__verify = False
+                if not self.__native_usb and self.__baudrate == self.__default_baudrate:
+                    self.__baudrate_checked = False
+        except:
+            super().__exit__(None, None, None)
+            raise
         return res
 
+    def __exit__(self, type, value, traceback):
+        if isinstance(value, TimeoutError) and self.__baudrate != self.__default_baudrate:
+            # MCU may have been reset to its default baudrate, check on next use
+            self.__verify = True
+        super().__exit__(type, value, traceback)
+
+    @property
+    def needs_baudrate(self) -> bool:
+        """True if negotiate_baudrate should be called."""
+        return not self.__baudrate_checked
+
+    def negotiate_baudrate(self):
+        """Switch to the highest baudrate that works (UART bridges only).
+        May take several seconds per rate tried. Errors are logged, not raised.
+        """
+        if self.__baudrate_checked: return
+        try:
+            with self as repl:
+                self.__negotiate_baudrate(repl)
+        except Exception as e:
+            logger.info(f"{self.__port}: baudrate negotiation failed ({e})")
+        finally:
+            self.__baudrate_checked = True
+
+    def __find_uid(self, repl):
+        # uid of device, trying the current, default and remembered baudrate
+        rates = [ self.__baudrate, self.__default_baudrate ]
+        if not self.__native_usb:
+            rates.append(device_settings().get(self.uid, 'baudrate'))
+        rates = [ r for r in dict.fromkeys(rates) if r ]
+        for i, baudrate in enumerate(rates):
+            self.__set_baudrate(baudrate)
+            try:
+                return repl.uid
+            except TimeoutError:
+                if i == len(rates) - 1:
+                    raise
+
+    def __negotiate_baudrate(self, repl):
+        # switch to the highest baudrate that works, remembered per uid
+        settings = device_settings()
+        fixed = Config.host_setting(self.uid, 'baudrate', None)
+        if fixed:
+            rates = [ fixed ]
+        else:
+            rates = sorted(Config.host_setting(self.uid, 'serial_baudrates', [921600, 460800, 230400]), reverse=True)
+            remembered = settings.get(self.uid, 'baudrate')
+            if remembered:
+                # skip rates that failed before
+                rates = [ remembered ] + [ r for r in rates if r < remembered ]
+        for baudrate in rates:
+            if baudrate == self.__baudrate:
+                break
+            if baudrate < self.__default_baudrate:
+                continue
+            if self.__switch_baudrate(repl, baudrate) is not False:
+                # switched, or not supported by the MCU
+                break
+        logger.info(f"{self.__port}: {self.__baudrate} baud")
+        if not fixed:
+            settings.put(self.uid, 'baudrate', self.__baudrate)
+            settings.save()
+
+    def __switch_baudrate(self, repl, baudrate):
+        # True if MCU and host switched to baudrate, None if MCU cannot switch
+        old = self.__baudrate
+        uarts = Config.host_setting(self.uid, 'serial_repl_uarts', [0])
+        timers = Config.host_setting(self.uid, 'serial_baudrate_timers', [-1, 3])
+        try:
+            err = repl.eval_func(_baudrate, baudrate, old, BAUDRATE_REVERT_MS, uarts, timers)
+        except ReplException as e:
+            err = e
+        if err:
+            logger.info(f"{self.__port}: cannot change baudrate ({err})")
+            return None
+        start = time.monotonic()
+        # MCU switches 50ms after the eval
+        time.sleep(0.1)
+        self.__set_baudrate(baudrate)
+        try:
+            if repl.eval_func(_echo, ECHO_PATTERN) == ECHO_PATTERN:
+                repl.eval_func(_baudrate_ok)
+                return True
+        except (ReplException, TimeoutError) as e:
+            logger.debug(f"{self.__port}: {baudrate} baud failed ({e})")
+        # wait for MCU to revert
+        self.__set_baudrate(old)
+        time.sleep(max(0, start + BAUDRATE_REVERT_MS / 1000 + 0.2 - time.monotonic()))
+        self.read_all()
+        return False
+
+    def __set_baudrate(self, baudrate):
+        self.__baudrate = baudrate
+        if self.__serial and self.__serial.baudrate != baudrate:
+            self.__serial.baudrate = baudrate
+
     def __eq__(self, other):
         return isinstance(other, SerialDevice) and self.__port == other.__port
 
@@ -64,4 +290,52 @@ class SerialDevice(Device):
         return self.__port
 
     def __repr__(self) -> str:
-        return f"SerialDevice {self.uid}, age {self.age:.1f}s at {self.__port}, {self.__baudrate} baud ({self.__description})"
\ No newline at end of file
+        return f"SerialDevice {self.uid}, age {self.age:.1f}s at {self.__port}, {self.__baudrate} baud ({self.__description})"
+
+
+##########################################################################
+# Code running on MCU
+
+# switch REPL UART to baudrate after the eval returns, and back to old
+# after revert_ms unless _baudrate_ok is called
+# the REPL UART is the first in uarts running at old baudrate, it is
+# re-initialized right away to check the port permits it
+# returns an error message if the switch is not possible
+def _baudrate(baudrate, old, revert_ms, uarts, timers):
+    import machine
+    uart = None
+    for i in uarts:
+        try:
+            u = machine.UART(i)
+            r = repr(u)
+            if abs(int(r.split('baudrate=')[1].split(',')[0]) - old) <= old // 50:
+                u.init(baudrate=old)
+                uart = u
+                break
+        except Exception:
+            pass
+    if uart is None:
+        return 'REPL UART not found in {}'.format(uarts)
+    # virtual (-1) rather than hardware timer, if available
+    global _baudrate_timer
+    _baudrate_timer = None
+    for i in timers:
+        try:
+            _baudrate_timer = machine.Timer(i)
+            break
+        except Exception:
+            pass
+    if _baudrate_timer is None:
+        return 'no timer in {}'.format(timers)
+    def revert(t):
+        uart.init(baudrate=old)
+    def switch(t):
+        uart.init(baudrate=baudrate)
+        t.init(mode=machine.Timer.ONE_SHOT, period=revert_ms, callback=revert)
+    _baudrate_timer.init(mode=machine.Timer.ONE_SHOT, period=50, callback=switch)
+
+def _baudrate_ok():
+    _baudrate_timer.deinit()
+
+def _echo(s):
+    return s
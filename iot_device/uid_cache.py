@@ -0,0 +1,72 @@
+from .config_store import Config
+from .cache_file import atomic_json_save
+
+import json
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+"""
+Uids of devices on serial ports, remembered across runs (`uids.json`).
+
+Entries are keyed by the USB identity of the port (vid:pid and serial
+number, or the location on the bus if the adapter has no serial number),
+so known boards are registered without asking them for their uid:
+
+    cache = UidCache()
+    uid = cache.get(usb_identity(port))
+"""
+
+
+class UidCache:
+
+    def __init__(self, name='uids.json'):
+        self.__file = os.path.join(os.path.expanduser(Config.get('cache_dir')), name)
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        try:
+            with open(self.__file) as f:
+                self.__cache = json.load(f)
+        except (OSError, ValueError):
+            self.__cache = {}
+
+    def get(self, identity):
+        """Cached uid for identity, None if unknown."""
+        return self.__cache.get(identity) if identity else None
+
+    def put(self, identity, uid):
+        if not (identity and uid): return
+        with self.__lock:
+            if self.__cache.get(identity) != uid:
+                self.__cache[identity] = uid
+                self.__dirty = True
+
+    def forget(self, identity):
+        with self.__lock:
+            if self.__cache.pop(identity, None):
+                self.__dirty = True
+
+    def save(self):
+        """Write cache to disk (if changed)."""
+        with self.__lock:
+            if not self.__dirty: return
+            try:
+                atomic_json_save(self.__file, self.__cache)
+                self.__dirty = False
+            except OSError as e:
+                logger.warning(f"Cannot save {self.__file}: {e}")
+
+
+def usb_identity(port):
+    """Stable identity of a USB serial port (serial.tools.list_ports info), None if unknown."""
+    if port.vid is None:
+        return None
+    vid_pid = "{:04x}:{:04x}".format(port.vid, port.pid or 0)
+    if port.serial_number:
+        return f"{vid_pid} {port.serial_number}"
+    if port.location:
+        return f"{vid_pid} @{port.location}"
+    return None
@@ -32,6 +32,7 @@ setuptools.setup(
             'iot_server=iot_device.device_server:main',
             'iot_discover_serial=iot_device.discover_serial:main',
             'iot_discover_net=iot_device.discover_net:main',
+            'iot_fleet=iot_device.fleet:main',
         ],
     },
     scripts = [ 'server.sh' ],
@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+# keep the user's config.py, hosts.py and caches out of the tests
+os.environ['IOT49'] = tempfile.mkdtemp(prefix='iot49-')
+
+import pytest
+from iot_device.default_config import default_config
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Empty `cache_dir` for the test."""
+    path = tmp_path / 'cache'
+    monkeypatch.setitem(default_config, 'cache_dir', str(path))
+    return path
+
+
+@pytest.fixture
+def host_dir(tmp_path, monkeypatch):
+    """Empty `host_dir` for the test."""
+    path = tmp_path / 'mcu'
+    path.mkdir()
+    monkeypatch.setitem(default_config, 'host_dir', str(path))
+    return path
@@ -0,0 +1,196 @@
+from iot_device.device import Device
+from iot_device.repl import ReplException
+
+from contextlib import contextmanager
+import builtins
+import os
+import sys
+import threading
+import traceback
+
+
+"""
+MCU code (_mcu_put, _mcu_batch, ...) running in a thread on the host.
+
+FakeMcu is a Device connected to sys.stdin and sys.stdout of the MCU code
+(replaced while it runs). Its output ends like in the raw REPL, with EOT,
+the exception (if any), EOT and the prompt. Ctrl-C from the host raises
+KeyboardInterrupt in the MCU code when it reads stdin. Files opened while it
+runs accept MicroPython's readinto(buf, size).
+
+    device = FakeMcu(mcu_dir)
+    with device.run(_mcu_put, *args):
+        _host_put(device, *args)
+"""
+
+EOT = b'\x04'
+
+
+class Pipe:
+
+    def __init__(self):
+        self.data = bytearray()
+        self.interrupted = False
+        self.cond = threading.Condition()
+
+    def put(self, data):
+        with self.cond:
+            self.data.extend(data)
+            self.cond.notify_all()
+
+    def interrupt(self):
+        with self.cond:
+            self.interrupted = True
+            self.cond.notify_all()
+
+    def get(self, size, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.data or self.interrupted, timeout)
+            if self.interrupted:
+                self.interrupted = False
+                raise KeyboardInterrupt()
+            res = bytes(self.data[:size])
+            del self.data[:size]
+            return res
+
+
+class Stdin:
+    """sys.stdin (and sys.stdin.buffer) of the MCU code."""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.buffer = self
+
+    def readinto(self, buf, size=None):
+        size = len(buf) if size is None else min(size, len(buf))
+        data = self.pipe.get(size)
+        buf[0:len(data)] = data
+        return len(data)
+
+    def read(self, size=1):
+        return self.pipe.get(size).decode()
+
+
+class Stdout:
+    """sys.stdout (and sys.stdout.buffer) of the MCU code."""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.buffer = self
+
+    def write(self, s):
+        self.pipe.put(s.encode() if isinstance(s, str) else bytes(s))
+
+    def flush(self):
+        pass
+
+
+class File:
+    """File with MicroPython's readinto."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def readinto(self, buf, size=None):
+        return self.f.readinto(memoryview(buf)[0:size])
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __iter__(self):
+        return iter(self.f)
+
+    def __enter__(self):
+        self.f.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.f.__exit__(*args)
+
+
+class FakeMcu(Device):
+
+    def __init__(self, mcu_dir, uid='fake-mcu', garble=None):
+        self.mcu_dir = str(mcu_dir)
+        # garble: index of write (e.g. frame) to corrupt
+        self.garble = garble
+        self.writes = 0
+        self.to_mcu = Pipe()
+        self.from_mcu = Pipe()
+        super().__init__(uid)
+
+    def read_raw(self, size=1):
+        try:
+            return self.from_mcu.get(size, timeout=0.5)
+        except KeyboardInterrupt:
+            return b''
+
+    def read_all_raw(self):
+        return self.read_raw(4096)
+
+    def write(self, data):
+        data = bytearray(data)
+        if self.writes == self.garble:
+            data[-1] ^= 0x01
+        self.writes += 1
+        if data == b'\x03':
+            self.to_mcu.interrupt()
+        else:
+            self.to_mcu.put(data)
+
+    def __hash__(self):
+        return hash(self.uid)
+
+    @contextmanager
+    def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on the MCU during the with block."""
+        th = threading.Thread(target=self.__run, args=(func, args, kwargs), daemon=True)
+        th.start()
+        try:
+            yield
+        finally:
+            th.join(5)
+            assert not th.is_alive()
+
+    def __run(self, func, args, kwargs):
+        stdin, stdout, cwd, stat, chdir = sys.stdin, sys.stdout, os.getcwd(), os.stat, os.chdir
+        _open = builtins.open
+        sys.stdin, sys.stdout = Stdin(self.to_mcu), Stdout(self.from_mcu)
+        builtins.open = lambda *args, **kwargs: File(_open(*args, **kwargs))
+        os.chdir(self.mcu_dir)
+        # MicroPython: '' is the current directory
+        os.stat = lambda path: stat(path or '.')
+        os.chdir = lambda path: chdir(path or '.')
+        try:
+            res = func(*args, **kwargs)
+            if res is not None:
+                print(res)
+            error = b''
+        except BaseException as e:
+            error = ''.join(traceback.format_exception_only(type(e), e)).encode()
+        finally:
+            sys.stdin, sys.stdout, os.stat, os.chdir, builtins.open = stdin, stdout, stat, chdir, _open
+            os.chdir(cwd)
+        self.from_mcu.put(EOT + error + EOT + b'>')
+
+
+class Local:
+    """Mixin for Repl classes: eval_func runs the MCU code on the FakeMcu."""
+
+    calls = None
+
+    def eval_func(self, func, *args, xfer_func=None, output=None, requires=(), **kwargs):
+        if self.calls is None:
+            self.calls = []
+        self.calls.append(func.__name__)
+        device = self.device
+        with device.run(func, *args, **kwargs):
+            if xfer_func:
+                xfer_func(device, *args, **kwargs)
+        res, error, _ = device.read_until(b'>').split(EOT)
+        if error:
+            raise ReplException(error.decode())
+        if output:
+            output.ans(res)
+            return None
+        return res.decode().strip()
@@ -0,0 +1,211 @@
+from iot_device.cache_file import atomic_json_save
+from iot_device.device_settings import DeviceSettings
+from iot_device.hash_cache import HashCache, file_digest
+from iot_device.host_index import HostIndex
+from iot_device.manifest import Manifest
+from iot_device.uid_cache import UidCache, usb_identity
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+import json
+import os
+import pytest
+
+
+def saved_files(cache_dir):
+    return sorted(str(p.relative_to(cache_dir)) for p in cache_dir.rglob('*') if p.is_file())
+
+
+@contextmanager
+def dump_fails(monkeypatch):
+    # json.dump fails halfway through writing
+    def dump(obj, f):
+        f.write('{"partial')
+        raise OSError("disk full")
+    with monkeypatch.context() as m:
+        m.setattr(json, 'dump', dump)
+        yield
+
+
+def test_uid_cache(cache_dir):
+    cache = UidCache()
+    cache.put('10c4:ea60 0001', 'uid-1')
+    cache.put('239a:8022 @1-1.2', 'uid-2')
+    cache.save()
+    assert saved_files(cache_dir) == ['uids.json']
+    cache = UidCache()
+    assert cache.get('10c4:ea60 0001') == 'uid-1'
+    cache.forget('10c4:ea60 0001')
+    cache.save()
+    assert UidCache().get('10c4:ea60 0001') is None
+    assert UidCache().get('239a:8022 @1-1.2') == 'uid-2'
+    assert UidCache().get(None) is None
+
+
+def test_usb_identity():
+    port = SimpleNamespace(vid=0x10c4, pid=0xea60, serial_number='0001', location='1-1.2')
+    assert usb_identity(port) == '10c4:ea60 0001'
+    port.serial_number = None
+    assert usb_identity(port) == '10c4:ea60 @1-1.2'
+    port.location = None
+    assert usb_identity(port) is None
+
+
+def test_device_settings(cache_dir):
+    settings = DeviceSettings()
+    settings.put('uid-1', 'drain_rate', 20000)
+    settings.put('uid-1', 'baudrate', 921600)
+    settings.put(None, 'baudrate', 1)
+    settings.save()
+    settings = DeviceSettings()
+    assert settings.get('uid-1', 'drain_rate') == 20000
+    assert settings.get('uid-1', 'baudrate') == 921600
+    assert settings.get('uid-2', 'baudrate', 115200) == 115200
+
+
+def test_hash_cache(cache_dir, tmp_path):
+    path = tmp_path / 'a.py'
+    path.write_bytes(b'print(1)\n')
+    cache = HashCache()
+    digest = cache.digest(str(path), 'sha256')
+    assert digest == file_digest(str(path), 'sha256')
+    cache.save()
+    assert HashCache().digest(str(path), 'sha256') == digest
+    assert HashCache().digest(str(path), 'crc32').startswith('crc32:')
+
+
+
+@pytest.mark.parametrize('cls, name', [
+    (UidCache, 'uids.json'),
+    (DeviceSettings, 'device_settings.json'),
+    (HashCache, 'digests.json'),
+    (HostIndex, 'host_index.json'),
+])
+def test_corrupt_file(cache_dir, cls, name):
+    cache_dir.mkdir()
+    (cache_dir / name).write_text('{"truncated')
+    cls()
+
+
+def test_atomic_save(cache_dir, monkeypatch):
+    path = str(cache_dir / 'state.json')
+    atomic_json_save(path, { 'v': 1 })
+    with dump_fails(monkeypatch):
+        with pytest.raises(OSError):
+            atomic_json_save(path, { 'v': 2 })
+    # previous version intact, no temporary files left
+    assert saved_files(cache_dir) == ['state.json']
+    assert json.loads((cache_dir / 'state.json').read_text()) == { 'v': 1 }
+
+
+def test_failed_save_is_retried(cache_dir, tmp_path, monkeypatch):
+    path = tmp_path / 'a.py'
+    path.write_bytes(b'print(1)\n')
+    cache = HashCache()
+    digest = cache.digest(str(path), 'sha256')
+    with dump_fails(monkeypatch):
+        cache.save()
+    assert saved_files(cache_dir) == []
+    cache.save()
+    assert HashCache().digest(str(path), 'sha256') == digest
+
+
+def test_concurrent_saves_use_separate_files(cache_dir, monkeypatch):
+    names = []
+    replace = os.replace
+    def record(src, dst):
+        names.append(src)
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', record)
+    for i in range(2):
+        atomic_json_save(str(cache_dir / 'state.json'), i)
+    assert len(set(names)) == 2
+    assert all(os.path.dirname(n) == str(cache_dir) for n in names)
+
+def make_tree(root):
+    (root / 'lib').mkdir(parents=True)
+    (root / 'main.py').write_bytes(b'import lib\n')
+    (root / 'lib' / 'util.py').write_bytes(b'x = 1\n')
+    (root / '.hidden').write_bytes(b'')
+
+
+def test_host_index(cache_dir, tmp_path):
+    root = tmp_path / 'base'
+    make_tree(root)
+    index = HostIndex()
+    files = index.files(str(root), '', 'base')
+    assert set(files) == { '', 'main.py', 'lib', os.path.join('lib', 'util.py') }
+    assert files['lib'][2] == -1
+    assert files['main.py'][0:1] == ('base', )
+    assert files['main.py'][2] == len(b'import lib\n')
+    index.save()
+    # reloaded index gives the same result
+    assert HostIndex().files(str(root), '', 'base') == files
+
+
+def test_host_index_walks_once(cache_dir, tmp_path):
+    root = tmp_path / 'base'
+    make_tree(root)
+    index = HostIndex()
+    files = index.files(str(root), '', 'base')
+    (root / 'new.py').write_bytes(b'')
+    assert index.files(str(root), '', 'base') == files
+    # a new index sees the change
+    assert 'new.py' in HostIndex().files(str(root), '', 'base')
+
+
+def test_host_index_drops_removed_directories(cache_dir, tmp_path):
+    root = tmp_path / 'base'
+    make_tree(root)
+    index = HostIndex()
+    index.files(str(root), '', 'base')
+    index.save()
+    (root / 'lib' / 'util.py').unlink()
+    (root / 'lib').rmdir()
+    index = HostIndex()
+    assert 'lib' not in index.files(str(root), '', 'base')
+    index.save()
+    saved = json.loads((cache_dir / 'host_index.json').read_text())
+    assert str(root / 'lib') not in saved
+
+
+def test_manifest(cache_dir):
+    fingerprint = ('gen-1', 120)
+    files = { 'main.py': (100, 11, None), 'lib': (100, -1, None) }
+    manifest = Manifest('30:ae:a4:1c:5c:18')
+    manifest.set_listing('', False, fingerprint, files)
+    manifest = Manifest('30:ae:a4:1c:5c:18')
+    assert manifest.listing('', False, fingerprint) == files
+    assert manifest.listing('', False, ('gen-2', 120)) is None
+    assert manifest.listing('', True, fingerprint) is None
+    assert saved_files(cache_dir) == [os.path.join('manifests', '30_ae_a4_1c_5c_18.json')]
+
+
+def test_manifest_changes(cache_dir):
+    manifest = Manifest('uid')
+    manifest.set_listing('', True, ('gen-1', 120), { 'main.py': (100, 11, 'sha256:aa') })
+    manifest.discard()
+    assert saved_files(cache_dir) == []
+    manifest.add('lib/util.py', 200, 6, lambda algorithm: algorithm + ':bb')
+    manifest.remove('main.py')
+    manifest.commit(('gen-2', 110))
+    files = Manifest('uid').listing('', True, ('gen-2', 110))
+    assert files == { 'lib/util.py': (200, 6, 'sha256:bb'), 'lib': (200, -1, None) }
+    # a listing with digests also serves requests without
+    assert Manifest('uid').listing('', False, ('gen-2', 110)) == files
+
+
+def test_manifest_corrupt_file(cache_dir):
+    path = cache_dir / 'manifests' / 'uid.json'
+    path.parent.mkdir(parents=True)
+    path.write_text('{"fingerprint": ["gen", 1], "listings": [')
+    assert Manifest('uid').listing('', False, ('gen', 1)) is None
+
+
+def test_manifest_atomic_save(cache_dir, monkeypatch):
+    manifest = Manifest('uid')
+    manifest.set_listing('', False, ('gen-1', 1), { 'main.py': (1, 1, None) })
+    with dump_fails(monkeypatch):
+        manifest.set_listing('', False, ('gen-2', 1), {})
+    assert saved_files(cache_dir) == [os.path.join('manifests', 'uid.json')]
+    assert Manifest('uid').listing('', False, ('gen-1', 1)) == { 'main.py': (1, 1, None) }
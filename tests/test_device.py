@@ -0,0 +1,66 @@
+from iot_device.device import Device
+
+import pytest
+
+
+class FakeDevice(Device):
+    """Device returning data in the chunks given."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sizes = []
+        super().__init__('fake')
+
+    def read_raw(self, size=1):
+        self.sizes.append(size)
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def read_all_raw(self):
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def write(self, data):
+        pass
+
+    def __hash__(self):
+        return hash('fake')
+
+
+def test_read_buffers_surplus():
+    dev = FakeDevice([b'abcdef', b'gh'])
+    assert dev.read(2) == b'ab'
+    assert dev.read(3) == b'cde'
+    # remaining buffered byte and the next chunk
+    assert dev.read(3) == b'fgh'
+    assert dev.sizes[0] > 2
+
+
+def test_read_short_on_timeout():
+    dev = FakeDevice([b'ab'])
+    assert dev.read(5) == b'ab'
+    assert dev.read(1) == b''
+
+
+def test_read_all_returns_buffer_first():
+    dev = FakeDevice([b'abcd', b'ef'])
+    assert dev.read(1) == b'a'
+    assert dev.read_all() == b'bcd'
+    assert dev.read_all() == b'ef'
+
+
+def test_read_until_keeps_following_data():
+    dev = FakeDevice([b'OK 1\x04', b'\x04>rest'])
+    assert dev.read_until(b'\x04>') == b'OK 1\x04\x04>'
+    assert dev.read(4) == b'rest'
+
+
+def test_read_until_pattern_across_chunks():
+    dev = FakeDevice([b'xx raw RE', b'PL; CTRL-B to exit\r', b'\n>'])
+    assert dev.read_until(b'raw REPL; CTRL-B to exit\r\n>') == b'xx raw REPL; CTRL-B to exit\r\n>'
+
+
+def test_read_until_timeout():
+    dev = FakeDevice([b'partial'])
+    with pytest.raises(TimeoutError):
+        dev.read_until(b'>', timeout=0.05)
+    # data received before the timeout is dropped
+    assert dev.read_all() == b''
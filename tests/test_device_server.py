@@ -0,0 +1,153 @@
+from iot_device.default_config import default_config
+from iot_device.device import Device
+from iot_device.device_server import DeviceServer, _advertisements, _auth_message, ADVERTISE_PROTOCOL
+from iot_device.discover import Discover
+from iot_device.net_device import NetDevice
+
+import json
+import socket
+import ssl
+import time
+import pytest
+
+
+def test_advertisements_single_message():
+    msgs = _advertisements('10.0.0.2', 50001, ['a', 'b'], ['c'])
+    assert len(msgs) == 1
+    msg = json.loads(msgs[0])
+    assert msg == { 'protocol': ADVERTISE_PROTOCOL, 'ip_addr': '10.0.0.2', 'ip_port': 50001,
+                    'uids': ['a', 'b'], 'gone': ['c'] }
+
+
+def test_advertisements_split():
+    uids = [ f"30:ae:a4:{i:02x}:5c:18" for i in range(200) ]
+    gone = [ 'gone-1', 'gone-2' ]
+    msgs = _advertisements('10.0.0.2', 50001, uids, gone, size=500)
+    assert len(msgs) > 1
+    assert all(len(m) <= 500 for m in msgs)
+    decoded = [ json.loads(m) for m in msgs ]
+    assert [ u for m in decoded for u in m['uids'] ] == uids
+    assert [ u for m in decoded for u in m['gone'] ] == gone
+
+
+def test_advertisements_empty():
+    assert _advertisements('10.0.0.2', 50001, []) == []
+
+
+def test_advertisements_oversized_uid():
+    # sent on its own, even if it does not fit
+    msgs = _advertisements('10.0.0.2', 50001, ['x' * 200, 'y'], size=100)
+    assert [ json.loads(m)['uids'] for m in msgs ] == [['x' * 200], ['y']]
+
+
+def test_auth_message():
+    msg, rest = _auth_message(bytearray(b'{"uid": "u", "password": "p"}\n\x01\x03'))
+    assert msg == { 'uid': 'u', 'password': 'p' }
+    assert rest == b'\x01\x03'
+
+
+def test_auth_message_unterminated():
+    # old clients do not send the newline
+    msg, rest = _auth_message(bytearray(b'{"uid": "u", "password": "p"}'))
+    assert msg == { 'uid': 'u', 'password': 'p' }
+    assert rest == b''
+
+
+def test_auth_message_incomplete():
+    assert _auth_message(bytearray(b'{"uid": "u", "pass')) == (None, None)
+
+
+@pytest.mark.parametrize('buf', [ b'not json\n', b'[1, 2]\n', b'"uid"' ])
+def test_auth_message_malformed(buf):
+    with pytest.raises(ValueError):
+        _auth_message(bytearray(buf))
+
+
+class EchoDevice(Device):
+    """Device echoing what is written to it, after delay seconds."""
+
+    def __init__(self, uid, delay=0):
+        self.delay = delay
+        self.mcu, self.host = socket.socketpair()
+        self.host.setblocking(False)
+        super().__init__(uid)
+
+    def read_raw(self, size=1):
+        try:
+            return self.host.recv(size)
+        except BlockingIOError:
+            return b''
+
+    def read_all_raw(self):
+        return self.read_raw(4096)
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.mcu.sendall(data)
+
+    def fileno(self):
+        return self.host.fileno()
+
+    def __hash__(self):
+        return hash(self.uid)
+
+
+class Sink(EchoDevice):
+    """Device answering 'end' when it receives it."""
+
+    def write(self, data):
+        time.sleep(0.01)
+        if data.endswith(b'end'):
+            self.mcu.sendall(b'end')
+
+
+class Registry(Discover):
+
+    def scan(self):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    port = free_port()
+    monkeypatch.setitem(default_config, 'connection_server_port', port)
+    monkeypatch.setitem(default_config, 'advertise_legacy', False)
+    discovery = Registry()
+    for dev in (EchoDevice('slow', delay=1), EchoDevice('fast'), Sink('sink')):
+        discovery.add_device(dev)
+    try:
+        DeviceServer(discovery)
+    except ssl.SSLError as e:
+        # e.g. OpenSSL rejecting the 1024 bit key of the self signed certificate
+        pytest.skip(f"cannot create server context ({e})")
+    time.sleep(0.2)
+    return port
+
+
+def adv(uid, port):
+    return { 'uid': uid, 'ip_addr': '127.0.0.1', 'ip_port': port }
+
+
+def test_slow_device_does_not_block_relay(server):
+    with NetDevice(adv('slow', server)) as slow, NetDevice(adv('fast', server)) as fast:
+        slow.device.write(b'x' * 1000)
+        time.sleep(0.1)
+        start = time.monotonic()
+        fast.device.write(b'ping')
+        assert fast.device.read(4) == b'ping'
+        assert time.monotonic() - start < 0.5
+        assert slow.device.read(1000) == b'x' * 1000
+
+
+def test_backlog(server):
+    # client is held back while the device is slow, nothing is lost
+    with NetDevice(adv('sink', server)) as sink:
+        sink.device.write(bytes(range(256)) * 4000)
+        sink.device.write(b'end')
+        assert sink.device.read(3) == b'end'
@@ -0,0 +1,57 @@
+from iot_device.device import Device
+from iot_device.discover import Discover
+
+import time
+
+
+class ClosingDevice(Device):
+
+    def __init__(self, uid):
+        self.closed = False
+        super().__init__(uid)
+
+    def read_raw(self, size=1):
+        return b''
+
+    def read_all_raw(self):
+        return b''
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def __hash__(self):
+        return hash(self.uid)
+
+
+class Registry(Discover):
+
+    def scan(self):
+        pass
+
+
+def test_remove_closes():
+    discover = Registry()
+    dev = ClosingDevice('a')
+    discover.add_device(dev)
+    discover.remove_device(dev)
+    assert discover.get_device('a') is None
+    assert dev.closed
+
+
+def test_evict_closes():
+    discover = Registry()
+    old, used, new = ClosingDevice('old'), ClosingDevice('used'), ClosingDevice('new')
+    for dev in (old, used, new):
+        discover.add_device(dev)
+    time.sleep(0.1)
+    new.seen()
+    with used:
+        discover.evict(0.05)
+        # in use, kept
+        assert discover.get_device('used') is used
+        assert not used.closed
+    assert discover.get_device('old') is None and old.closed
+    assert discover.get_device('new') is new and not new.closed
@@ -0,0 +1,201 @@
+from iot_device.default_config import default_config
+from iot_device.fcopy import (Fcopy, _host_deflate, _host_delta, _host_file, _host_frames, _host_put, _mcu_patch,
+                              _mcu_put, COMPRESS_BLOCK, COMPRESS_WBITS)
+from fake_mcu import FakeMcu, Local
+
+from types import SimpleNamespace
+import os
+import random
+import zlib
+import pytest
+
+
+def random_bytes(n, seed=1):
+    r = random.Random(seed)
+    return bytes(r.randrange(256) for _ in range(n))
+
+
+def block_sums(data, block):
+    # checksums reported by _mcu_block_sums
+    return [ (sum(data[i:i+block]), zlib.crc32(data[i:i+block]))
+             for i in range(0, len(data) - block + 1, block) ]
+
+def patch(tmp_path, old, new, block):
+    remote_file = tmp_path / 'table.bin'
+    remote_file.write_bytes(old)
+    delta = _host_delta(new, block_sums(old, block), block)
+    delta_file = tmp_path / 'table.bin.delta'
+    delta_file.write_bytes(delta)
+    assert _mcu_patch(str(remote_file), str(delta_file), block, len(new))
+    assert not delta_file.exists()
+    assert not (tmp_path / 'table.bin.tmp').exists()
+    return delta, remote_file.read_bytes()
+
+
+def test_delta_small_change(tmp_path):
+    block = 64
+    old = random_bytes(50 * block)
+    new = old[:1000] + b'changed' + old[1010:]
+    delta, patched = patch(tmp_path, old, new, block)
+    assert patched == new
+    assert len(delta) < 4 * block
+
+
+@pytest.mark.parametrize('new', [
+    b'',
+    b'short',
+    random_bytes(1000, seed=2),
+])
+def test_delta_unrelated(tmp_path, new):
+    _, patched = patch(tmp_path, random_bytes(1000), new, 64)
+    assert patched == new
+
+
+def test_delta_moved_blocks(tmp_path):
+    block = 32
+    old = random_bytes(20 * block)
+    new = old[10*block:] + b'inserted' + old[:10*block]
+    delta, patched = patch(tmp_path, old, new, block)
+    assert patched == new
+    # copy instructions only, and the inserted literal
+    assert delta.count(b'C') >= 2 and len(delta) < 64
+
+
+def test_delta_format():
+    block = 4
+    old = b'aaaabbbbcccc'
+    delta = _host_delta(b'bbbbccccXY', block_sums(old, block), block)
+    assert delta == b'C' + (1).to_bytes(4, 'big') + (2).to_bytes(4, 'big') + \
+                    b'L' + (2).to_bytes(4, 'big') + b'XY'
+
+
+def test_patch_size_mismatch(tmp_path):
+    remote_file = tmp_path / 'f'
+    remote_file.write_bytes(b'abcd')
+    delta_file = tmp_path / 'f.delta'
+    delta_file.write_bytes(b'L' + (3).to_bytes(4, 'big') + b'xyz')
+    with pytest.raises(ValueError):
+        _mcu_patch(str(remote_file), str(delta_file), 4, 4)
+    # original kept
+    assert remote_file.read_bytes() == b'abcd'
+
+
+def test_host_deflate(tmp_path):
+    path = tmp_path / 'data.py'
+    data = (b'x = 1\n' + random_bytes(300) + b'\n') * 40
+    path.write_bytes(data)
+    st = os.stat(path)
+    stream = _host_deflate(str(path), st.st_mtime_ns, st.st_size)
+    blocks = []
+    while stream:
+        n = int.from_bytes(stream[0:2], 'big')
+        blocks.append(stream[2:2+n])
+        stream = stream[2+n:]
+    assert len(blocks) == -(-len(data) // COMPRESS_BLOCK)
+    # the MCU decompresses with a window of 2**COMPRESS_WBITS bytes
+    assert b''.join(zlib.decompress(b, -COMPRESS_WBITS) for b in blocks) == data
+
+
+@pytest.mark.parametrize('encoding', ['esc', 'b64'])
+def test_put_compressed(host_dir, tmp_path, encoding):
+    data = (b'print("hello")\n' + random_bytes(100)) * 100
+    (host_dir / 'main.py').write_bytes(data)
+    st = os.stat(host_dir / 'main.py')
+    filesize = len(_host_deflate(str(host_dir / 'main.py'), st.st_mtime_ns, st.st_size))
+    mcu = tmp_path / 'mcu_fs'
+    mcu.mkdir()
+    device = FakeMcu(mcu)
+    with device.run(_mcu_put, 'main.py', 'main.py', filesize, encoding, 4, 'zlib'):
+        assert _host_put(device, 'main.py', 'main.py', filesize, encoding, 4, 'zlib')
+    assert device.read_until(b'>') == b'\x04\x04>'
+    assert (mcu / 'main.py').read_bytes() == data
+
+
+def upload(tmp_path, data, encoding):
+    path = tmp_path / 'f'
+    path.write_bytes(data)
+    device = SimpleNamespace(uid='uid', negotiated={ 'binary_encoding': encoding, 'decompressor': 'zlib' })
+    return Fcopy(device)._Fcopy__upload(str(path), os.stat(path))
+
+
+def test_upload_compressed(tmp_path):
+    data = b'print("hello")\n' * 100
+    size, encoding, decompressor = upload(tmp_path, data, 'hex')
+    assert (encoding, decompressor) == ('hex', 'zlib')
+    assert size < len(data) // 10
+
+
+@pytest.mark.parametrize('data', [
+    # incompressible
+    random_bytes(3000),
+    # too small
+    b'print(1)\n' * 20,
+])
+def test_upload_not_compressed(tmp_path, data):
+    size, encoding, decompressor = upload(tmp_path, data, 'esc')
+    assert size == len(data) and decompressor is None
+
+
+@pytest.fixture
+def no_replace(monkeypatch):
+    # filesystem that does not rename over existing files
+    # failing: destinations of renames that fail once
+    rename = os.rename
+    failing = []
+    def no_replace(src, dst):
+        if os.path.exists(dst):
+            raise OSError(17, 'EEXIST')
+        if dst in failing:
+            failing.remove(dst)
+            raise OSError(28, 'ENOSPC')
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', no_replace)
+    return failing
+
+
+def test_patch_no_replace(tmp_path, no_replace):
+    new = b'0123' * 10
+    _, patched = patch(tmp_path, b'abcd' * 10, new, 4)
+    assert patched == new
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['table.bin']
+
+
+def test_patch_rename_fails(tmp_path, no_replace):
+    remote_file = tmp_path / 'f'
+    remote_file.write_bytes(b'abcd')
+    delta_file = tmp_path / 'f.delta'
+    delta_file.write_bytes(b'L' + (4).to_bytes(4, 'big') + b'wxyz')
+    no_replace.append(str(remote_file))
+    with pytest.raises(OSError):
+        _mcu_patch(str(remote_file), str(delta_file), 4, 4)
+    # original restored, temporary files removed
+    assert remote_file.read_bytes() == b'abcd'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['f']
+
+
+class LocalFcopy(Local, Fcopy):
+    """Fcopy with the MCU code running on the host, in directory mcu."""
+
+    def __init__(self, mcu, **negotiated):
+        super().__init__(FakeMcu(mcu))
+        self.device.negotiated.update(negotiated)
+
+
+def test_fpatch(tmp_path, host_dir, monkeypatch):
+    monkeypatch.setitem(default_config, 'xfer_delta_min', 1024)
+    mcu = tmp_path / 'mcu_fs'
+    mcu.mkdir()
+    old = random_bytes(20000)
+    new = old[:5000] + b'changed' + old[5007:]
+    (mcu / 'big.bin').write_bytes(old)
+    (host_dir / 'big.bin').write_bytes(new)
+    _host_file.cache_clear()
+    _host_frames.cache_clear()
+    repl = LocalFcopy(mcu, xfer_window=4, binary_encoding='esc', decompressor=None)
+    assert repl.fpatch('big.bin', 'big.bin')
+    assert repl.calls == ['_mcu_block_sums', '_mcu_put', '_mcu_patch']
+    assert (mcu / 'big.bin').read_bytes() == new
+    assert sorted(p.name for p in mcu.iterdir()) == ['big.bin']
+    # the delta does not take the place of project files in the caches
+    assert _host_file.cache_info().currsize == 1
+    assert _host_frames.cache_info().currsize == 0
@@ -0,0 +1,50 @@
+from iot_device.default_config import default_config
+from iot_device.net_device import NetDevice
+from iot_device import net_device
+
+import socket
+import threading
+import time
+import pytest
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_connect_failure():
+    dev = NetDevice({ 'uid': 'uid', 'ip_addr': '127.0.0.1', 'ip_port': closed_port() })
+    for _ in range(2):
+        # fails the same way on the next attempt
+        with pytest.raises(ConnectionRefusedError):
+            with dev:
+                pass
+
+
+class FakeSocket:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_reaper(monkeypatch):
+    monkeypatch.setitem(default_config, 'net_pool_idle', 0.2)
+    dev = NetDevice({ 'uid': 'uid', 'ip_addr': '127.0.0.1', 'ip_port': 1 }, pooled=True)
+    threads = threading.active_count()
+    socks = []
+    for _ in range(50):
+        socks.append(FakeSocket())
+        dev._NetDevice__socket = socks[-1]
+        dev._NetDevice__to_pool()
+    # replaced connections are closed, one thread for all
+    assert all(s.closed for s in socks[:-1])
+    assert threading.active_count() <= threads + 1
+    time.sleep(0.5)
+    assert socks[-1].closed
+    assert not net_device._pool
+    assert threading.active_count() == threads
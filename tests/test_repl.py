@@ -0,0 +1,147 @@
+from iot_device.repl import Repl, ReplException, EOT, MCU_RAW_PASTE
+
+from types import SimpleNamespace
+import pytest
+
+
+def _mcu_helper():
+    pass
+
+
+class ScriptedRepl(Repl):
+    """Repl failing the first evals with the errors given."""
+
+    def __init__(self, errors, xfer_errors=()):
+        super().__init__(SimpleNamespace(negotiated={}, seen=lambda: None))
+        self.errors = list(errors)
+        self.xfer_errors = list(xfer_errors)
+        self.code = []
+
+    def _Repl__exec_part_1(self, code):
+        self.code.append(code)
+
+    def _Repl__exec_part_2(self, output):
+        if self.errors:
+            raise ReplException(self.errors.pop(0))
+        return b'ok'
+
+    def xfer(self, device, *args):
+        if self.xfer_errors:
+            raise self.xfer_errors.pop(0)
+
+
+def test_helpers_installed_once():
+    repl = ScriptedRepl([])
+    assert repl.eval_func(_mcu_helper) == 'ok'
+    assert 'def _mcu_helper' in repl.code[0]
+    assert repl.eval_func(_mcu_helper) == 'ok'
+    assert 'def _mcu_helper' not in repl.code[1]
+
+
+def test_helpers_reinstalled():
+    repl = ScriptedRepl([])
+    repl.eval_func(_mcu_helper)
+    # MCU was reset
+    repl.errors.append("Traceback\nNameError: name '_iot49' isn't defined\n")
+    assert repl.eval_func(_mcu_helper) == 'ok'
+    assert 'def _mcu_helper' in repl.code[-1]
+
+
+@pytest.mark.parametrize('error, retried', [
+    # helper check failed during the transfer
+    ("Transfer aborted (Traceback\nNameError: _iot49: _mcu_helper not installed)", True),
+    # device error, e.g. a failed delete, must not be repeated
+    ("Transfer aborted (Traceback\nOSError: [Errno 2] ENOENT)", False),
+])
+def test_xfer_retry(error, retried):
+    repl = ScriptedRepl([])
+    repl.eval_func(_mcu_helper)
+    repl.xfer_errors.append(ReplException(error))
+    if retried:
+        assert repl.eval_func(_mcu_helper, xfer_func=repl.xfer) == 'ok'
+        assert len(repl.code) == 3
+    else:
+        with pytest.raises(ReplException):
+            repl.eval_func(_mcu_helper, xfer_func=repl.xfer)
+        assert len(repl.code) == 2
+
+
+class PasteDevice:
+    """Device in the raw REPL, answering raw-paste requests like MicroPython.
+    firmware: 'paste', 'refuse' (R\\x00) or 'old' (ignores the request)
+    abort: number of bytes after which the device aborts reception
+    """
+
+    def __init__(self, firmware='paste', window=32, abort=None):
+        self.firmware = firmware
+        self.window = window
+        self.abort = abort
+        self.negotiated = {}
+        self.replies = bytearray()
+        self.received = bytearray()
+        self.pasting = False
+
+    def write(self, data):
+        if data == MCU_RAW_PASTE:
+            self.replies += { 'paste': b'R\x01' + self.window.to_bytes(2, 'little'),
+                              'refuse': b'R\x00',
+                              'old': b'raw REPL; CTRL-B to exit\r\n>' }[self.firmware]
+            self.pasting = self.firmware == 'paste'
+        elif data == EOT and self.pasting:
+            self.replies += EOT
+            self.pasting = False
+        else:
+            self.received += data
+
+    def write_direct(self, data):
+        assert self.pasting and len(data) <= self.window
+        self.received += data
+        if len(self.received) % self.window == 0:
+            if self.abort and len(self.received) >= self.abort:
+                self.replies += EOT
+            else:
+                # ready for the next window
+                self.replies += b'\x01'
+
+    def read(self, size=1):
+        res = bytes(self.replies[:size])
+        del self.replies[:size]
+        return res
+
+    def read_until(self, pattern, timeout=5):
+        i = self.replies.find(pattern)
+        if i < 0:
+            raise TimeoutError()
+        return self.read(i + len(pattern))
+
+    def drained(self, size, seconds):
+        pass
+
+
+def test_raw_paste():
+    code = b'print("hello")\n' * 100
+    device = PasteDevice()
+    assert Repl(device)._Repl__raw_paste(code)
+    assert device.received == code
+    assert device.negotiated['raw_paste'] is True
+    assert not device.replies
+
+
+@pytest.mark.parametrize('firmware', ['refuse', 'old'])
+def test_raw_paste_not_supported(firmware):
+    device = PasteDevice(firmware)
+    repl = Repl(device)
+    assert not repl._Repl__raw_paste(b'print(1)')
+    assert device.negotiated['raw_paste'] is False
+    # back at the raw REPL prompt
+    assert not device.replies
+    # not asked again
+    device.firmware = None
+    assert not repl._Repl__raw_paste(b'print(1)')
+
+
+def test_raw_paste_aborted():
+    device = PasteDevice(abort=64)
+    with pytest.raises(ReplException):
+        Repl(device)._Repl__raw_paste(b'x = 1\n' * 100)
+    assert len(device.received) == 64
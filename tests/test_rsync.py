@@ -0,0 +1,84 @@
+from iot_device.rsync import Rsync
+from fake_mcu import FakeMcu, Local
+
+import os
+import pytest
+
+
+class LocalRsync(Local, Rsync):
+    """Rsync with the MCU code running on the host, in directory mcu."""
+
+    def __init__(self, mcu):
+        super().__init__(FakeMcu(mcu, uid='uid'))
+
+    def sync_time(self, tolerance=10):
+        pass
+
+
+class Output:
+
+    def __init__(self):
+        self.text = ''
+
+    def ans(self, s):
+        self.text += s.decode() if isinstance(s, bytes) else s
+
+    def err(self, s):
+        self.ans(s)
+
+
+@pytest.fixture
+def trees(tmp_path, host_dir, cache_dir):
+    mcu = tmp_path / 'mcu_fs'
+    (mcu / 'lib').mkdir(parents=True)
+    (mcu / 'lib' / 'util.py').write_bytes(b'x = 1\n')
+    (host_dir / 'base' / 'lib').mkdir(parents=True)
+    (host_dir / 'base' / 'lib' / 'util.py').write_bytes(b'x = 1\n')
+    # host copy is newer
+    os.utime(mcu / 'lib' / 'util.py', (0, 0))
+    os.utime(mcu / 'lib', (0, 0))
+    return mcu, host_dir / 'base'
+
+
+def test_manifest_reused(trees):
+    mcu, _ = trees
+    repl = LocalRsync(mcu)
+    files = repl.mcu_files(Output(), '/')
+    assert repl.calls.count('_mcu_list') == 1
+    assert repl.mcu_files(Output(), '/') == files
+    assert repl.calls.count('_mcu_list') == 1
+
+
+def test_fingerprint_root_changes(trees):
+    mcu, _ = trees
+    repl = LocalRsync(mcu)
+    repl.mcu_files(Output(), '/')
+    # changed by someone else
+    (mcu / 'main.py').write_bytes(b'')
+    assert 'main.py' in repl.mcu_files(Output(), '/')
+
+
+def test_digests_ignore_manifest(trees):
+    mcu, _ = trees
+    repl = LocalRsync(mcu)
+    assert repl.rdiff(Output(), digests=True) == ({}, [], {})
+    # same size edit in a subdirectory, not seen by the fingerprint
+    (mcu / 'lib' / 'util.py').write_bytes(b'x = 2\n')
+    os.utime(mcu / 'lib' / 'util.py', (0, 0))
+    assert repl.rdiff(Output(), digests=True) == ({}, [], { 'lib/util.py': 'base' })
+    assert repl.calls.count('_mcu_list') == 2
+
+
+def test_commit_with_next_listing(trees):
+    mcu, _ = trees
+    repl = LocalRsync(mcu)
+    repl.mcu_files(Output(), '/')
+    for _ in range(2):
+        (mcu / 'lib' / 'tmp.py').write_bytes(b'')
+        assert repl.rm_rf('lib/tmp.py') == 'True'
+    # single changes do not set the fingerprint
+    assert repl.calls.count('_mcu_fingerprint') == 1
+    repl.calls.clear()
+    files = repl.mcu_files(Output(), '/')
+    assert repl.calls == ['_mcu_fingerprint']
+    assert set(files) == { '', 'lib', 'lib/util.py' }
@@ -0,0 +1,204 @@
+from iot_device.fcopy import (_encode, _frame_header, _host_batch, _host_get, _host_put, _mcu_batch, _mcu_get,
+                              _mcu_put, _wait_ack,
+                              XferError, ESCAPED, FRAME_PAYLOAD_SIZE)
+from iot_device.repl import ReplException
+from fake_mcu import FakeMcu
+
+import binascii
+import random
+import re
+import pytest
+
+
+def random_bytes(n, seed=1):
+    r = random.Random(seed)
+    return bytes(r.randrange(256) for _ in range(n))
+
+
+@pytest.fixture
+def mcu(tmp_path):
+    path = tmp_path / 'mcu_fs'
+    path.mkdir()
+    return path
+
+
+def end_of_eval(device):
+    # output and error message of the MCU code
+    return device.read_until(b'>').split(b'\x04')[0:2]
+
+
+def test_frame_header():
+    payload = b'\x00\xff' * 10
+    header = _frame_header(0x1ff, payload)
+    assert len(header) + FRAME_PAYLOAD_SIZE <= 254
+    seq, size, checksum = int(header[0:2], 16), int(header[2:6], 16), int(header[6:10], 16)
+    assert (seq, size, checksum) == (0xff, len(payload), sum(payload) & 0xffff)
+
+
+class Replies:
+    """Device sending data to the host."""
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.written = b''
+
+    def read(self, size=1):
+        res = bytes(self.data[:size])
+        del self.data[:size]
+        return res
+
+    def read_until(self, pattern, timeout=5):
+        i = self.data.find(pattern)
+        if i < 0:
+            raise TimeoutError()
+        return self.read(i + len(pattern))
+
+    def write(self, data):
+        self.written += data
+
+
+def test_wait_ack():
+    assert _wait_ack(Replies(b'\x0603'), 0) == 4
+    # sequence numbers wrap around
+    assert _wait_ack(Replies(b'\x0601'), 255) == 258
+
+
+@pytest.mark.parametrize('data, error', [
+    (b'\x1502\x04Traceback\nValueError: frame 2: checksum error\x04>', XferError),
+    (b'xyz', XferError),
+    (b'\x0700\x04Traceback\nOSError: [Errno 2] ENOENT\x04>', ReplException),
+    (b'\x04Traceback\nNameError: _iot49: _mcu_put not installed\x04>', ReplException),
+])
+def test_wait_ack_errors(data, error):
+    device = Replies(data)
+    with pytest.raises(ReplException) as e:
+        _wait_ack(device, 0)
+    # only lost or garbled frames are transfer (window) problems
+    assert type(e.value) is error
+    assert device.written == b'\x03'
+
+
+@pytest.mark.parametrize('window', [1, 2, 4, 127])
+@pytest.mark.parametrize('size', [0, 1, FRAME_PAYLOAD_SIZE, 10000])
+def test_put(host_dir, mcu, window, size):
+    data = (b'print("hello")\n' * 1000)[:size]
+    (host_dir / 'main.py').write_bytes(data)
+    device = FakeMcu(mcu)
+    with device.run(_mcu_put, 'main.py', 'main.py', size, None, window):
+        assert _host_put(device, 'main.py', 'main.py', size, None, window)
+    assert end_of_eval(device) == [b'', b'']
+    assert (mcu / 'main.py').read_bytes() == data
+
+
+def test_put_garbled_frame(host_dir, mcu):
+    (host_dir / 'main.py').write_bytes(b'x = 1\n' * 1000)
+    device = FakeMcu(mcu, garble=2)
+    with pytest.raises(XferError) as e:
+        with device.run(_mcu_put, 'main.py', 'main.py', 6000, None, 4):
+            _host_put(device, 'main.py', 'main.py', 6000, None, 4)
+    assert 'frame 2: checksum error' in str(e.value)
+
+
+def test_put_device_error(host_dir, mcu):
+    (host_dir / 'main.py').write_bytes(b'x = 1\n' * 1000)
+    device = FakeMcu(mcu)
+    # MCU error, not a transfer problem
+    with pytest.raises(ReplException) as e:
+        with device.run(_mcu_put, 'main.py', 'no_dir/main.py', 6000, None, 4):
+            _host_put(device, 'main.py', 'no_dir/main.py', 6000, None, 4)
+    assert type(e.value) is ReplException
+    assert 'No such file' in str(e.value)
+
+
+@pytest.mark.parametrize('window', [1, 4])
+def test_get(host_dir, mcu, window):
+    data = random_bytes(5000)
+    (mcu / 'data.bin').write_bytes(data)
+    device = FakeMcu(mcu)
+    with device.run(_mcu_get, 'data.bin', 'data.bin', len(data), window):
+        assert _host_get(device, 'data.bin', 'data.bin', len(data), window)
+    assert end_of_eval(device) == [b'', b'']
+    assert (host_dir / 'data.bin').read_bytes() == data
+
+
+def unescape(payload):
+    # inverse of the 'esc' encoding (see _mcu_put)
+    return re.sub(b'\x10(.)', lambda m: bytes([m.group(1)[0] ^ 0x40]), payload, flags=re.DOTALL)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'print("hello")\n' * 100,
+    random_bytes(3000),
+    b'\x03' * 1000,
+])
+def test_encode_esc(data):
+    frames = list(_encode(data, 'esc'))
+    assert all(0 < len(f) <= FRAME_PAYLOAD_SIZE for f in frames)
+    # REPL control characters only appear escaped
+    assert not any(ESCAPED.search(re.sub(b'\x10.', b'', f, flags=re.DOTALL)) for f in frames)
+    assert b''.join(unescape(f) for f in frames) == data
+
+
+@pytest.mark.parametrize('encoding, decode', [
+    ('hex', binascii.unhexlify),
+    ('b64', binascii.a2b_base64),
+    (None, bytes),
+])
+def test_encode(encoding, decode):
+    data = random_bytes(2000)
+    frames = list(_encode(data, encoding))
+    assert all(0 < len(f) <= FRAME_PAYLOAD_SIZE for f in frames)
+    assert b''.join(decode(f) for f in frames) == data
+
+
+@pytest.mark.parametrize('encoding', ['esc', 'b64', 'hex'])
+def test_put_binary(host_dir, mcu, encoding):
+    data = random_bytes(3000) + b'\x01\x02\x03\x04\x05\x10' * 100
+    (host_dir / 'data.bin').write_bytes(data)
+    device = FakeMcu(mcu)
+    with device.run(_mcu_put, 'data.bin', 'data.bin', len(data), encoding, 4):
+        assert _host_put(device, 'data.bin', 'data.bin', len(data), encoding, 4)
+    assert end_of_eval(device) == [b'', b'']
+    assert (mcu / 'data.bin').read_bytes() == data
+
+
+def test_batch(host_dir, mcu):
+    (mcu / 'old').mkdir()
+    (mcu / 'old' / 'a.py').write_bytes(b'')
+    (host_dir / 'main.py').write_bytes(b'print("hello")\n' * 100)
+    (host_dir / 'data.bin').write_bytes(random_bytes(3000))
+    ops = [
+        ('D', 'old'),
+        ('M', 'lib/sub'),
+        ('F', 'lib/sub/main.py', 1500, None, None, 'main.py'),
+        ('F', 'data.bin', 3000, 'esc', None, 'data.bin'),
+        # nothing to delete
+        ('D', 'missing'),
+    ]
+    status = []
+    device = FakeMcu(mcu)
+    with device.run(_mcu_batch, len(ops), 4):
+        assert _host_batch(device, len(ops), 4, ops=ops, status=status)
+    assert end_of_eval(device) == [b'', b'']
+    assert status == [True, True, True, True, False]
+    assert not (mcu / 'old').exists()
+    assert (mcu / 'lib' / 'sub' / 'main.py').read_bytes() == (host_dir / 'main.py').read_bytes()
+    assert (mcu / 'data.bin').read_bytes() == (host_dir / 'data.bin').read_bytes()
+
+
+def test_batch_put_fails(host_dir, mcu):
+    (host_dir / 'main.py').write_bytes(b'x = 1\n')
+    ops = [
+        ('M', 'lib'),
+        ('F', 'no_dir/main.py', 6, None, None, 'main.py'),
+        ('M', 'lib2'),
+    ]
+    status = []
+    device = FakeMcu(mcu)
+    # ends the batch
+    with pytest.raises(ReplException):
+        with device.run(_mcu_batch, len(ops), 4):
+            _host_batch(device, len(ops), 4, ops=ops, status=status)
+    assert status == [True, False]
+    assert not (mcu / 'lib2').exists()